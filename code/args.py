@@ -35,8 +35,94 @@ def get_args():
                         type=int, 
                         default=64,
                         help='Batch size for training')
+    parser.add_argument('--proposal_store', 
+                        type=str, 
+                        default=None,
+                        help='Path to the compiled proposal store (built on first use)')
+    parser.add_argument('--build_workers', 
+                        type=int, 
+                        default=1,
+                        help='Number of processes used to build the datasets')
+    parser.add_argument('--crop_cache', 
+                        type=str, 
+                        default=None,
+                        help='Directory for the resized crop cache (disabled if not given)')
+    parser.add_argument('--crop_cache_gb', 
+                        type=float, 
+                        default=64,
+                        help='Disk budget of the crop cache in GB')
+    parser.add_argument('--crop_backend', 
+                        type=str, 
+                        default='pil',
+                        choices=['pil', 'roi_align'],
+                        help='pil: per-box RGB crop and resize, roi_align: batched grayscale ROI resampling')
+    parser.add_argument('--uint8_crops', 
+                        action='store_true',
+                        help='Load single-channel uint8 crops and normalize them on the device')
+    parser.add_argument('--mask_vocab', 
+                        type=str, 
+                        default=None,
+                        help='JSON file holding the TF-IDF masking vocabulary (written on first fit, loaded afterwards)')
+    parser.add_argument('--token_cache', 
+                        type=str, 
+                        default=None,
+                        help='Directory caching the pre-tokenized prompts')
+    parser.add_argument('--ragged_rois', 
+                        action='store_true',
+                        help='Keep only the real proposals of every image (masked in the model) instead of padding to topk with duplicates')
+    parser.add_argument('--bucket_by_length', 
+                        action='store_true',
+                        help='Group weighted training batches by prompt length (needs pre-tokenized prompts)')
+    parser.add_argument('--precision', 
+                        type=str, 
+                        default='fp32',
+                        choices=['fp32', 'bf16', 'fp16'],
+                        help='Autocast precision for training and testing (fp16 only on GPU, with loss scaling)')
+    parser.add_argument('--dist_backend', 
+                        type=str, 
+                        default=None,
+                        choices=['nccl', 'gloo'],
+                        help='Process group backend when launched with torchrun (default: nccl with CUDA, gloo otherwise)')
+    parser.add_argument('--checkpoint_every', 
+                        type=int, 
+                        default=500,
+                        help='Training steps between full training-state checkpoints (last.pt, also written after every epoch; 0 = epochs only)')
+    parser.add_argument('--resume', 
+                        action='store_true',
+                        help='Resume from last.pt in checkpoint_model_save at the exact epoch and batch')
 
     # Model Params
+    parser.add_argument('--grad_checkpointing', 
+                        action='store_true',
+                        help='Recompute ViT block and RoBERTa layer activations in backward to save memory')
+    parser.add_argument('--crop_chunk_size', 
+                        type=int, 
+                        default=0,
+                        help='Crops per ViT call inside the forward (0 = all batch_size*topk crops at once)')
+    parser.add_argument('--dedup_crops', 
+                        action='store_true',
+                        help='Encode identical crops of a batch once in the ViT')
+    parser.add_argument('--vit_feature_store', 
+                        type=str, 
+                        default=None,
+                        help='Directory storing the frozen ViT prefix tokens per crop, reused from the second epoch (also freezes cls_token/pos_embed)')
+    parser.add_argument('--vit_feature_storage', 
+                        type=str, 
+                        default='fp16',
+                        choices=['fp32', 'fp16', 'int8'],
+                        help='Precision of the stored prefix tokens')
+    parser.add_argument('--vit_feature_store_gb', 
+                        type=float, 
+                        default=256,
+                        help='Disk budget of the ViT feature store in GB, crops beyond it are recomputed')
+    parser.add_argument('--text_cache_size', 
+                        type=int, 
+                        default=0,
+                        help='Prompts whose frozen RoBERTa hidden states are kept in an LRU cache (0 disables it)')
+    parser.add_argument('--sentence_cache_size', 
+                        type=int, 
+                        default=20000,
+                        help='Prompts whose sentence embedding is reused across evaluation batches (0 disables it)')
     parser.add_argument('--rob_layers_unfreeze', 
                         type=int, 
                         default=2,
@@ -0,0 +1,61 @@
+import os
+from abc import ABC, abstractmethod
+import torch
+
+
+class ExportedBackend(ABC):
+    # an exported MMBCD graph behind the eager call signature used by test_code and ExamPredictor:
+    # backend(crops, inputids, attmask) -> (logits, None)
+    # the graphs take padded crops, checkpoints trained with --ragged_rois run eagerly
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+    @abstractmethod
+    def run(self, crops, inputids, attmask):
+        # logits [B, 2] of the exported graph
+        pass
+
+    def __call__(self, crops, inputids, attmask, roi_mask=None):
+        assert roi_mask is None, 'exported graphs take padded crops, run ragged checkpoints eagerly'
+        logits = self.run(crops, inputids, attmask)
+        return logits.to(crops.device), None
+
+
+class TorchScriptBackend(ExportedBackend):
+    def __init__(self, path, device='cpu'):
+        self.device = device
+        self.module = torch.jit.load(path, map_location=device)
+        self.module.eval()
+
+    def run(self, crops, inputids, attmask):
+        with torch.no_grad():
+            return self.module(crops.to(self.device), inputids.to(self.device), attmask.to(self.device))
+
+
+class OnnxBackend(ExportedBackend):
+    # ONNX Runtime on the CPU, with all graph optimizations (fused attention / layer norm / GELU kernels)
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [node.name for node in self.session.get_inputs()]
+
+    def run(self, crops, inputids, attmask):
+        inputs = [crops, inputids, attmask]
+        feed = {name: tensor.cpu().numpy() for name, tensor in zip(self.input_names, inputs)}
+        logits, = self.session.run(['logits'], feed)
+        return torch.from_numpy(logits)
+
+
+def load_backend(path, device='cpu'):
+    # by extension: .onnx -> ONNX Runtime, anything else (.ts / .pt) -> TorchScript
+    if os.path.splitext(path)[1] == '.onnx':
+        return OnnxBackend(path)
+    return TorchScriptBackend(path, device)
@@ -0,0 +1,66 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+
+def cpu_snapshot(value):
+    # copies every tensor of a (nested) state to the CPU, so training can go on changing the originals
+    if torch.is_tensor(value):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: cpu_snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(cpu_snapshot(item) for item in value)
+    return value
+
+
+def rng_state():
+    state = {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class AsyncCheckpointer():
+    # torch.save on a background thread: save() only takes the CPU snapshot, the serialization and
+    # the disk write overlap with the next training steps; one write in flight at a time
+    # files are written to a temporary name and renamed, a crash never leaves a truncated checkpoint
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, path, state):
+        snapshot = cpu_snapshot(state)
+        self.wait()
+        self.thread = threading.Thread(target=self.write, args=(path, snapshot), daemon=True)
+        self.thread.start()
+
+    def write(self, path, snapshot):
+        try:
+            tmp_path = f'{path}.tmp{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                torch.save(snapshot, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except Exception as error:
+            self.error = error
+
+    def wait(self):
+        # blocks until the last write is on disk, and re-raises its error here
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
@@ -0,0 +1,146 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import numpy as np
+
+VERSION = 2
+ALIGN = 4096
+
+
+def crop_digest(img_path, proposals, img_size, crop_mode=''):
+    # identifies the crops of one image: path, the real (unpadded) boxes, the output size and
+    # how the pixels were produced (crop backend and channels, as in feature_store.crop_key)
+    h = hashlib.blake2b(digest_size=8)
+    h.update(img_path.encode('utf-8'))
+    h.update(np.ascontiguousarray(proposals, dtype=np.float32).tobytes())
+    h.update(np.int64(img_size).tobytes())
+    h.update(crop_mode.encode('utf-8'))
+    return np.frombuffer(h.digest(), dtype=np.uint64)[0] | np.uint64(1)
+
+
+class CropCache():
+    # sharded, memory-mapped store of resized uint8 crops, one slot of [topk, C, S, S] per dataset row
+    # every shard file is: uint64 digest per slot | crop slots; a zero digest marks an empty slot
+    # shards beyond the disk budget are evicted least-recently-used first (eviction='lru')
+    # or simply not cached (eviction='none')
+    def __init__(self, cache_dir, num_items, topk, img_size, channels=3, crop_mode='', namespace='', budget_gb=64, shard_size=64, eviction='lru'):
+        assert eviction in ('lru', 'none')
+        self.topk = topk
+        self.img_size = img_size
+        self.channels = channels
+        self.shard_size = shard_size
+        self.eviction = eviction
+        self.num_shards = -(-num_items // shard_size)
+
+        params = {'version': VERSION, 'topk': topk, 'img_size': img_size, 'channels': channels, 'crop_mode': crop_mode, 'shard_size': shard_size, 'namespace': namespace}
+        fingerprint = hashlib.blake2b(json.dumps(params, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+        self.cache_dir = os.path.join(cache_dir, fingerprint)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(os.path.join(self.cache_dir, 'params.json'), 'w') as f:
+            json.dump(params, f)
+
+        self.slot_shape = (topk, channels, img_size, img_size)
+        self.header_bytes = shard_size * 8 + (-(shard_size * 8)) % ALIGN
+        self.shard_bytes = self.header_bytes + shard_size * int(np.prod(self.slot_shape))
+        self.max_shards = max(int(budget_gb * 1024**3) // self.shard_bytes, 1)
+
+        self.pid = None
+        self.shards = {}
+        self.touched = {}
+
+    def __getstate__(self):
+        # memmaps are reopened in every DataLoader worker
+        state = self.__dict__.copy()
+        state['pid'] = None
+        state['shards'] = {}
+        state['touched'] = {}
+        return state
+
+    def shard_path(self, shard):
+        return os.path.join(self.cache_dir, f'shard_{shard:06d}.bin')
+
+    def open_shard(self, shard, create):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.shards = {}
+            self.touched = {}
+
+        path = self.shard_path(shard)
+        try:
+            inode = os.stat(path).st_ino
+        except FileNotFoundError:
+            inode = None
+        cached = self.shards.get(shard)
+        if cached is not None and cached[0] == inode:
+            return cached[1], cached[2]
+        self.shards.pop(shard, None)
+
+        if inode is None:
+            if not create or not self.make_room():
+                return None, None
+            # create under a temporary name and link, so concurrent workers agree on one file
+            tmp_path = f'{path}.tmp{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                f.truncate(self.shard_bytes)
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                pass
+            os.remove(tmp_path)
+            inode = os.stat(path).st_ino
+
+        digests = np.memmap(path, dtype=np.uint64, mode='r+', shape=(self.shard_size,))
+        slots = np.memmap(path, dtype=np.uint8, mode='r+', offset=self.header_bytes, shape=(self.shard_size,) + self.slot_shape)
+        self.shards[shard] = (inode, digests, slots)
+        self.touch(shard, force=True)
+        return digests, slots
+
+    def touch(self, shard, force=False):
+        # shard mtime is the recency used by the LRU eviction, refreshed at most once a minute per process
+        now = time.time()
+        if force or now - self.touched.get(shard, 0) > 60:
+            self.touched[shard] = now
+            try:
+                os.utime(self.shard_path(shard))
+            except FileNotFoundError:
+                pass
+
+    def make_room(self):
+        existing = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.startswith('shard_') and name.endswith('.bin')]
+        if len(existing) < self.max_shards:
+            return True
+        if self.eviction == 'none':
+            return False
+
+        # shard mtimes are refreshed whenever a process opens them, oldest goes first
+        existing.sort(key=lambda path: os.stat(path).st_mtime if os.path.exists(path) else 0)
+        for path in existing[:len(existing) - self.max_shards + 1]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return True
+
+    def get(self, index, digest):
+        shard = index // self.shard_size
+        digests, slots = self.open_shard(shard, create=False)
+        if digests is None or digests[index % self.shard_size] != digest:
+            return None
+        self.touch(shard)
+        return slots[index % self.shard_size]
+
+    def put(self, index, digest, crops):
+        digests, slots = self.open_shard(index // self.shard_size, create=True)
+        if digests is None:
+            return
+        slot = index % self.shard_size
+        # invalidate first, so a reader never pairs a new digest with half-written crops
+        digests[slot] = 0
+        slots[slot, :len(crops)] = crops
+        digests[slot] = digest
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        self.shards = {}
@@ -9,51 +9,262 @@ import copy
 import cv2
 import random
 from torchvision import transforms
+from torchvision.ops import roi_align
 import torch
 from sklearn.feature_extraction.text import TfidfVectorizer
 import re
+import json
+from concurrent.futures import ThreadPoolExecutor
+from nms import non_max_suppression
+from proposal_store import ProposalStore, build_proposals
+from crop_cache import CropCache, crop_digest
+from feature_store import crop_key
+from manifest import StringArray, load_manifest
+import hashlib
+
+def yolo_to_pascal(boxes, W, H):
+    # (cx, cy, w, h) relative boxes [N, 4] -> integer (x1, y1, x2, y2) pixels, truncated like int()
+    cx, cy, w, h = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    bbox = np.stack([(cx-w/2)*W, (cy-h/2)*H, (cx+w/2)*W, (cy+h/2)*H], axis=1)
+    return np.trunc(bbox).astype(np.int64)
+
+def batch_inputs(batch, tokenizer=None, max_length=90):
+    # crops, input_ids, attention_mask, labels of a collated batch; the tokenizer is only
+    # needed when the dataset was built without pre-tokenized prompts
+    if 'input_ids' in batch:
+        return batch['crops'], batch['input_ids'], batch['attention_mask'], batch['labels']
+    texts = tokenizer(list(batch['texts']), padding=True, truncation=True, return_tensors='pt', max_length=max_length)
+    return batch['crops'], texts['input_ids'], texts['attention_mask'], batch['labels']
+
+def pad_crops(crops):
+    # [B, K_max, C, S, S] zero padded to the largest crop count of the batch, roi_mask [B, K_max]
+    counts = torch.tensor([len(sample) for sample in crops])
+    padded = crops[0].new_zeros((len(crops), int(counts.max())) + crops[0].shape[1:])
+    for row, sample in enumerate(crops):
+        padded[row, :len(sample)] = sample
+    roi_mask = torch.arange(padded.shape[1])[None, :] < counts[:, None]
+    return padded, roi_mask
+
+def batch_roi_mask(batch, device):
+    # [B, K] bool of the real crops of a ragged batch (ragged_rois=True), None otherwise
+    if 'roi_mask' not in batch:
+        return None
+    return batch['roi_mask'].to(device)
 
 class all_mammo():
-    def __init__(self, csv_path, img_base, text_base, iou_threshold=0.1, topk=5, img_size=224, mask_ratio=0.2, enable_mask=True):
+    def __init__(self, csv_path, img_base, text_base, iou_threshold=0.1, topk=5, img_size=224, mask_ratio=0.2, enable_mask=True, nms_backend='numpy', proposal_store=None, build_workers=1, crop_cache=None, crop_cache_gb=64, crop_backend='pil', uint8_crops=False, mask_vocab=None, tokenizer=None, token_cache=None, max_length=90, ragged_rois=False):
         self.img_base = img_base
         self.word_mask_ratio = mask_ratio
         self.text_base = text_base
         self.enable_mask = enable_mask
         self.img_size = img_size
+        self.nms_backend = nms_backend
+        self.proposal_store = proposal_store
+        self.build_workers = build_workers
+        self.topk = topk
+        self.mask_vocab = mask_vocab
+        self.max_length = max_length
+        # images keep only their real proposals; collate pads to the batch maximum and adds a roi_mask
+        self.ragged_rois = ragged_rois
+        assert crop_backend in ('pil', 'roi_align')
+        self.crop_backend = crop_backend
+        # uint8 single-channel crops, converted and normalized on the device by MMBCD.preprocess
+        self.uint8_crops = uint8_crops
+        self.crop_channels = 1 if (crop_backend == 'roi_align' or uint8_crops) else 3
+        # PIL and roi_align crops differ in pixels, caches and stores keep them apart
+        self.crop_mode = f'{crop_backend}:{self.crop_channels}'
+        self.resize = transforms.Resize((img_size, img_size))
+        self.to_tensor = transforms.ToTensor()
+        self.normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
         self.image_path_list, self.text, self.label, self.both_label = self.csv_to_list(csv_path) 
         self.prompt_list = self.create_valid_prompt(self.text, self.label, self.both_label)
 
-        self.box_text_path = self.generate_file_path(self.image_path_list)
-        self.all_proposals = self.create_proposals(iou_threshold, topk)
-        self.word_freq_list, self.word_list = self.get_tfidf_values(self.text)
+        if self.build_workers > 1:
+            # TF-IDF fitting runs on a thread while the process pool builds the proposals
+            with ThreadPoolExecutor(1) as executor:
+                tfidf_future = executor.submit(self.load_mask_vocab, self.text)
+                self.all_proposals = self.create_proposals(iou_threshold, topk)
+                self.word_freq_list, self.word_list = tfidf_future.result()
+        else:
+            self.all_proposals = self.create_proposals(iou_threshold, topk)
+            self.word_freq_list, self.word_list = self.load_mask_vocab(self.text)
         # import pdb; pdb.set_trace()
+
+        # prompts as packed word ids; masking drops ids flagged in a shared bitmap inside collate(),
+        # so a new selection made by the main process is seen by already running (persistent) workers
+        self.word_vocab, self.word_index, self.prompt_word_ids, self.prompt_word_offsets = self.tokenize_words(self.prompt_list)
+        self.mask_bitmap = torch.zeros(len(self.word_vocab), dtype=torch.bool).share_memory_()
         self.words2mask = self.select_random_words()
+
+        # prompts pre-tokenized once (fast tokenizer) so batches come out as padded ids
+        self.pretokenized = tokenizer is not None
+        if self.pretokenized:
+            self.bos_id, self.eos_id, self.pad_id = tokenizer.bos_token_id, tokenizer.eos_token_id, tokenizer.pad_token_id
+            self.token_ids, self.token_word_ids, self.token_offsets = self.pretokenize(tokenizer, token_cache)
+            self.prompt_lengths = np.minimum(np.diff(self.token_offsets), max_length - 2) + 2
+
+        # opt-in cache of the resized uint8 crops, filled on the first pass over the data
+        self.crop_cache = None
+        if crop_cache is not None:
+            namespace = hashlib.blake2b(self.image_path_list.offsets.tobytes() + self.image_path_list.buffer.tobytes(), digest_size=8).hexdigest()
+            self.crop_cache = CropCache(crop_cache, len(self.image_path_list), topk, img_size, channels=self.crop_channels, crop_mode=self.crop_mode, namespace=namespace, budget_gb=crop_cache_gb)
+        self.crop_key_table = None
         
 
     def __len__(self):
         return len(self.label)
 
     def __getitem__(self, index):
-        # Text -> 
-        title = self.prompt_list[index]
-        if self.enable_mask:
-            title = self.update_report(title) # masking 20% words
+        # Text -> masked and assembled per batch in collate()
 
         # Label -> 
-        label = self.label[index]
+        label = int(self.label[index])
 
         # Proposals -> 
         proposals = self.all_proposals[index]
+        if self.ragged_rois:
+            proposals = proposals[:self.proposal_counts[index]]
 
         # Image Paths ->
         image_path = self.image_path_list[index]
 
         # Crops -> 
-        crops = self.create_crops(image_path, proposals, self.img_size)
+        if self.crop_cache is not None:
+            crops = self.cached_crops(index, image_path, proposals)
+        elif self.uint8_crops:
+            crops = torch.from_numpy(self.resized_uint8_crops(image_path, proposals))
+        elif self.crop_backend == 'roi_align':
+            crops = self.normalize_crops(self.create_crops_roi_align(image_path, proposals, self.img_size))
+        else:
+            crops = torch.stack(self.create_crops(image_path, proposals, self.img_size))
         
-        return torch.stack(crops), title, label   
+        return crops, label, index
         # return torch.stack(crops), title, label, proposals, image_paths
+
+    def collate(self, batch):
+        labels = torch.tensor([sample[1] for sample in batch], dtype=torch.long)
+        index = torch.tensor([sample[2] for sample in batch], dtype=torch.long)
+        inputs = {'labels': labels, 'index': index}
+        if self.ragged_rois:
+            inputs['crops'], inputs['roi_mask'] = pad_crops([sample[0] for sample in batch])
+        else:
+            inputs['crops'] = torch.stack([sample[0] for sample in batch])
+        if self.pretokenized:
+            inputs['input_ids'], inputs['attention_mask'] = self.masked_token_ids(index.numpy())
+        else:
+            inputs['texts'] = self.masked_prompts(index.numpy())
+        return inputs
+
+    def masked_token_ids(self, indices):
+        # drops the tokens of masked words, truncates like the tokenizer (max_length with <s> </s>)
+        # and pads only up to the longest prompt of the batch
+        starts = self.token_offsets[indices]; ends = self.token_offsets[indices+1]
+        positions = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        token_ids = self.token_ids[positions]
+        keep = np.ones(len(positions), dtype=bool)
+        if self.enable_mask:
+            keep = ~self.mask_bitmap.numpy()[self.token_word_ids[positions]]
+
+        rows = []
+        position = 0
+        for length in ends - starts:
+            rows.append(token_ids[position:position+length][keep[position:position+length]][:self.max_length - 2])
+            position += length
+
+        seq_len = max(len(row) for row in rows) + 2
+        input_ids = np.full((len(rows), seq_len), self.pad_id, dtype=np.int64)
+        attention_mask = np.zeros((len(rows), seq_len), dtype=np.int64)
+        for row, ids in enumerate(rows):
+            input_ids[row, 0] = self.bos_id
+            input_ids[row, 1:len(ids)+1] = ids
+            input_ids[row, len(ids)+1] = self.eos_id
+            attention_mask[row, :len(ids)+2] = 1
+        return torch.from_numpy(input_ids), torch.from_numpy(attention_mask)
+
+    def pretokenize(self, tokenizer, token_cache=None):
+        # token ids of every prompt (no special tokens, untruncated) plus, per token, the corpus id
+        # of the word it belongs to, so that word masking can be applied on the ids
+        cache_path = None
+        if token_cache is not None:
+            key = hashlib.blake2b(digest_size=8)
+            key.update(self.prompt_list.offsets.tobytes()); key.update(self.prompt_list.buffer.tobytes())
+            key.update(f'{tokenizer.name_or_path}:{len(tokenizer)}'.encode('utf-8'))
+            os.makedirs(token_cache, exist_ok=True)
+            cache_path = os.path.join(token_cache, f'tokens_{key.hexdigest()}.npz')
+            if os.path.isfile(cache_path):
+                cached = np.load(cache_path)
+                return cached['token_ids'], cached['token_word_ids'], cached['token_offsets']
+
+        token_ids = []; token_word_ids = []
+        token_offsets = np.zeros(len(self.prompt_list) + 1, dtype=np.int64)
+        chunk_size = 4096
+        for start in tqdm(range(0, len(self.prompt_list), chunk_size), desc='tokenizing prompts', position=0, leave=True):
+            prompts = [self.prompt_list[index] for index in range(start, min(start + chunk_size, len(self.prompt_list)))]
+            encoded = tokenizer(prompts, add_special_tokens=False, return_offsets_mapping=True)
+            for offset, (ids, spans) in enumerate(zip(encoded['input_ids'], encoded['offset_mapping'])):
+                index = start + offset
+                word_starts = [match.start() for match in re.finditer(r'\S+', prompts[offset])]
+                prompt_words = self.prompt_word_ids[self.prompt_word_offsets[index]:self.prompt_word_offsets[index+1]]
+                # a token belongs to the last word starting at or before it
+                local_words = np.searchsorted(word_starts, [span[0] for span in spans], side='right') - 1
+                token_ids.append(np.array(ids, dtype=np.int32))
+                token_word_ids.append(prompt_words[np.clip(local_words, 0, None)] if len(prompt_words) else np.zeros(len(ids), dtype=np.int32))
+                token_offsets[index+1] = token_offsets[index] + len(ids)
+
+        token_ids = np.concatenate(token_ids) if token_ids else np.zeros(0, dtype=np.int32)
+        token_word_ids = np.concatenate(token_word_ids).astype(np.int32) if token_word_ids else np.zeros(0, dtype=np.int32)
+        if cache_path is not None:
+            np.savez(cache_path, token_ids=token_ids, token_word_ids=token_word_ids, token_offsets=token_offsets)
+        return token_ids, token_word_ids, token_offsets
+
+    def masked_prompts(self, indices):
+        if not self.enable_mask:
+            return [self.prompt_list[index] for index in indices]
+
+        # one bitmap lookup for every word of the batch, masking 20% words
+        starts = self.prompt_word_offsets[indices]; ends = self.prompt_word_offsets[indices+1]
+        word_ids = self.prompt_word_ids[np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])]
+        keep = ~self.mask_bitmap.numpy()[word_ids]
+
+        prompts = []
+        position = 0
+        for length in ends - starts:
+            ids = word_ids[position:position+length][keep[position:position+length]]
+            prompts.append(" ".join(self.word_vocab[word_id] for word_id in ids))
+            position += length
+        return prompts
+
+    def tokenize_words(self, prompts):
+        # whitespace-separated words -> ids into a corpus word vocabulary
+        word_index = {}
+        word_ids = []
+        offsets = np.zeros(len(prompts) + 1, dtype=np.int64)
+        for index, prompt in enumerate(prompts):
+            for word in re.findall(r'\S+', prompt):
+                word_ids.append(word_index.setdefault(word, len(word_index)))
+            offsets[index+1] = len(word_ids)
+        word_vocab = StringArray.from_list(list(word_index.keys()))
+        return word_vocab, word_index, np.array(word_ids, dtype=np.int32), offsets
+
+    def set_epoch(self, epoch, seed=42):
+        # reproducible masking selection per epoch
+        return self.select_random_words(random.Random(seed * 100003 + epoch))
     
+    def load_mask_vocab(self, text_data):
+        # masking vocabulary: not needed without masking, reused from mask_vocab when it was saved before
+        if not self.enable_mask:
+            return [], []
+        if self.mask_vocab is not None and os.path.isfile(self.mask_vocab):
+            with open(self.mask_vocab) as f:
+                vocab = json.load(f)
+            return vocab['weights'], vocab['words']
+
+        word_freq_list, word_list = self.get_tfidf_values(text_data)
+        if self.mask_vocab is not None:
+            with open(self.mask_vocab, 'w') as f:
+                json.dump({'words': word_list, 'weights': word_freq_list}, f)
+        return word_freq_list, word_list
+
     def get_tfidf_values(self, text_data):
         texts_c = []
         for text in text_data:
@@ -64,36 +275,35 @@ class all_mammo():
 
         vectorizer = TfidfVectorizer(stop_words='english')
         tfidf_matrix = vectorizer.fit_transform(texts_c)
-        tfidf_df = pd.DataFrame(tfidf_matrix.toarray(), columns=vectorizer.get_feature_names_out())
-        top_words = tfidf_df.sum().sort_values(ascending=False).head(100)
-        return top_words.to_list(), top_words.keys().to_list()
+        # column sums straight from the sparse matrix, no dense N x vocab copy
+        word_scores = np.asarray(tfidf_matrix.sum(axis=0)).ravel()
+        top_words = np.argsort(-word_scores, kind='stable')[:100]
+        return word_scores[top_words].tolist(), vectorizer.get_feature_names_out()[top_words].tolist()
     
-    def select_random_words(self):
+    def select_random_words(self, rng=random):
         word_list, word_freq = self.word_list, self.word_freq_list
-        total_freq = sum(word_freq)
-        probabilities = [freq / total_freq for freq in word_freq]
-        # probabilities = [1 / len(word_list) for freq in word_freq]
-        sampled_words = random.choices(word_list, weights=probabilities, k=int(len(word_list)*self.word_mask_ratio))
+        sampled_words = []
+        if len(word_list) > 0:
+            total_freq = sum(word_freq)
+            probabilities = [freq / total_freq for freq in word_freq]
+            # probabilities = [1 / len(word_list) for freq in word_freq]
+            sampled_words = rng.choices(word_list, weights=probabilities, k=int(len(word_list)*self.word_mask_ratio))
+
+        # in place, the bitmap lives in shared memory
+        self.words2mask = sampled_words
+        self.mask_bitmap.zero_()
+        self.mask_bitmap[torch.tensor([self.word_index[word] for word in sampled_words if word in self.word_index], dtype=torch.long)] = True
         return sampled_words
 
-    def update_report(self, report):
-        words = re.findall(r'\S+|\s+', report)
-        masked_words = []
-        for word in words:
-            if word not in self.words2mask: masked_words.append(word)
-        new_report = " ".join(masked_words)
-        return new_report
-    
-
-    
     def csv_to_list(self, csv_path):
-        df = pd.read_csv(csv_path)
+        # packed strings and int8 label arrays instead of Python lists, see manifest.py
+        columns = load_manifest(csv_path)
 
-        return (df['im_path'].tolist(), df['text'].tolist(), df['cancer'].tolist(), df['all_views_cancer'].tolist())
-        # return (df['im_path'].tolist()[:201], df['text'].tolist()[:201], df['cancer'].tolist()[:201], df['all_views_cancer'].tolist()[:201])
+        return (columns['im_path'], columns['text'], columns['cancer'], columns['all_views_cancer'])
 
     def create_valid_prompt(self, text, label, both_label):
         lds = len(text)
+        assert np.isin(both_label, [0, 1]).all()
 
         prompt = []
         for x in range(lds):
@@ -107,7 +317,8 @@ class all_mammo():
                 if label[x]==0: 
                     prompt.append(f'Indication:')
             
-        return prompt
+        # runs of whitespace collapsed, so the masked, unmasked and pre-tokenized paths see the same text
+        return StringArray.from_list([' '.join(text.split()) for text in prompt])
 
     def generate_file_path(self, im_paths):
         text_paths = [(im_path.rstrip(".png")+"_preds.txt") for im_path in im_paths]
@@ -115,51 +326,113 @@ class all_mammo():
         return text_paths
     
     def create_proposals(self, iou_threshold, topk): 
-        all_proposals = []
-
-        for index, img_path in enumerate(tqdm(self.image_path_list, total=len(self.image_path_list), desc='generating proposals', position=0, leave=True)):
-        # for index, img_path in enumerate(self.image_path_list):
-            proposal_path = os.path.join(self.text_base, self.box_text_path[index])            
-            img_path = os.path.join(self.img_base, img_path)            
-
-            assert os.path.isfile(proposal_path)
-            
-            # for each im_path, get NMS boxes
-            boxes = np.loadtxt(proposal_path, dtype=np.float32)
-            proposals = self.non_max_suppression(boxes, iou_threshold=iou_threshold)
+        proposal_paths = [os.path.join(self.text_base, box_path) for box_path in self.generate_file_path(self.image_path_list)]
+
+        # for each im_path, get NMS boxes (compiled once into the proposal store if one is given)
+        if self.proposal_store is not None:
+            store = ProposalStore(self.proposal_store, iou_threshold, topk, nms_backend=self.nms_backend, workers=self.build_workers)
+            boxes, counts = store.fetch(proposal_paths)
+        else:
+            boxes, counts = build_proposals(proposal_paths, iou_threshold, topk, nms_backend=self.nms_backend, workers=self.build_workers)
+
+        # one [N, topk, 5] array rather than one array object per image
+        self.proposal_counts = np.array(counts, dtype=np.int32)
+        all_proposals = np.array(boxes, dtype=np.float32)
+        if self.ragged_rois:
+            return all_proposals
+        for index in np.where(self.proposal_counts < topk)[0]:
+            all_proposals[index] = self.pad_proposals(all_proposals[index, :self.proposal_counts[index]], topk)
 
-            # sample if number of proposals is less than topk
-            if len(proposals) < topk:
-                # Randomly sample from the existing proposals and append to the end
-                additional_proposals = random.choices(proposals, k=topk - len(proposals))
-                proposals = np.concatenate([proposals, additional_proposals])
+        return all_proposals
 
-            # select top k out of those boxes over connf_threshold
-            proposals = proposals[:topk]
-            all_proposals.append(proposals)
+    def pad_proposals(self, proposals, topk):
+        # sample if number of proposals is less than topk
+        if len(proposals) < topk:
+            # Randomly sample from the existing proposals and append to the end
+            additional_proposals = random.choices(proposals, k=topk - len(proposals))
+            proposals = np.concatenate([proposals, additional_proposals])
 
-        return all_proposals
+        # select top k out of those boxes over connf_threshold
+        return proposals[:topk]
     
     def create_crops(self, img_path, proposals, img_size):
-        transform = transforms.Compose([
-            transforms.Resize((img_size, img_size)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        # crop the images for the top k boxes, resizing to img_size x img_size
+        crop_lis = []
+        for pil_crop in self.create_resized_crops(img_path, proposals, img_size):
+            crop_lis.append(self.normalize(self.to_tensor(pil_crop)))
+        
+        # return the crops
+        return crop_lis
 
-        # crop the images for the top k boxes 
+    def create_resized_crops(self, img_path, proposals, img_size, mode='RGB'):
+        resize = self.resize if img_size == self.img_size else transforms.Resize((img_size, img_size))
         crop_lis = []
-        img = Image.open(os.path.join(self.img_base, img_path)).convert('RGB')
+        img = Image.open(os.path.join(self.img_base, img_path)).convert(mode)
         for j,box in enumerate(proposals):
             pascal_box = self.convert_yolo_pascal(box[:4], img)
-            pil_crop = img.crop(pascal_box)
-            # resizing image to 244x244
-            pil_crop = transform(pil_crop)
-
-            crop_lis.append(pil_crop)
-        
-        # return the crops
+            crop_lis.append(resize(img.crop(pascal_box)))
         return crop_lis
+
+    def create_crops_roi_align(self, img_path, proposals, img_size):
+        # decode once as grayscale and resample every box in one batched roi_align call -> [K, 1, S, S] in [0, 1]
+        img = np.asarray(Image.open(os.path.join(self.img_base, img_path)).convert('L'))
+        H, W = img.shape
+        boxes = self.convert_yolo_pascal_batch(proposals[:, :4], W, H)
+
+        # only the region covering all boxes (plus a pixel for interpolation) is converted to float
+        x0 = int(np.clip(boxes[:, 0].min() - 1, 0, W)); x1 = int(np.clip(boxes[:, 2].max() + 1, x0, W))
+        y0 = int(np.clip(boxes[:, 1].min() - 1, 0, H)); y1 = int(np.clip(boxes[:, 3].max() + 1, y0, H))
+        region = torch.from_numpy(img[y0:y1, x0:x1].copy()).float().div(255)[None, None]
+
+        rois = torch.from_numpy(boxes - np.array([x0, y0, x0, y0])).float()
+        rois = torch.cat([torch.zeros(len(rois), 1), rois], dim=1)
+        return roi_align(region, rois, output_size=(img_size, img_size), spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+    def normalize_crops(self, crops):
+        # float crops in [0, 1] with 1 or 3 channels -> ImageNet-normalized 3 channel crops
+        if crops.shape[1] == 1:
+            crops = crops.expand(-1, 3, -1, -1)
+        return self.normalize(crops)
+
+    def resized_uint8_crops(self, img_path, proposals):
+        if self.crop_backend == 'roi_align':
+            crops = self.create_crops_roi_align(img_path, proposals, self.img_size)
+            return crops.mul(255).round().to(torch.uint8).numpy()
+        if self.crop_channels == 1:
+            return np.stack([np.asarray(crop)[None] for crop in self.create_resized_crops(img_path, proposals, self.img_size, mode='L')])
+        return np.stack([np.asarray(crop).transpose(2, 0, 1) for crop in self.create_resized_crops(img_path, proposals, self.img_size)])
+
+    def cached_crops(self, index, img_path, proposals):
+        # only the real proposals are cached, padded duplicates are gathered from them
+        count = self.proposal_counts[index]
+        digest = crop_digest(img_path, proposals[:count], self.img_size, self.crop_mode)
+        crops = self.crop_cache.get(index, digest)
+        if crops is None:
+            crops = self.resized_uint8_crops(img_path, proposals[:count])
+            self.crop_cache.put(index, digest, crops)
+
+        crops = torch.from_numpy(np.asarray(crops[:count]))
+        if count < len(proposals):
+            crops = crops[self.padding_order(proposals, count)]
+        if self.uint8_crops:
+            return crops
+        # same arithmetic as ToTensor + Normalize on the PIL crop
+        return self.normalize_crops(crops.float().div(255))
+
+    def crop_keys(self, indices):
+        # uint64 key of every crop slot [len(indices), topk], built on first use
+        if self.crop_key_table is None:
+            self.crop_key_table = np.zeros(self.all_proposals.shape[:2], dtype=np.uint64)
+            for index, image_path in enumerate(self.image_path_list):
+                for slot, box in enumerate(self.all_proposals[index]):
+                    self.crop_key_table[index, slot] = crop_key(image_path, box, self.img_size, self.crop_mode)
+        return self.crop_key_table[np.asarray(indices)]
+
+    def padding_order(self, proposals, count):
+        order = np.arange(len(proposals))
+        for j in range(count, len(proposals)):
+            order[j] = np.where((proposals[:count] == proposals[j]).all(1))[0][0]
+        return torch.from_numpy(order)
             
     def convert_yolo_pascal(self, box, image):
         W,H = image.size
@@ -168,56 +441,15 @@ class all_mammo():
         y1 = int((cy-h/2)*H); y2 = int((cy+h/2)*H)
         bbox = [x1, y1, x2, y2]
         return bbox
+
+    def convert_yolo_pascal_batch(self, boxes, W, H):
+        # vectorized convert_yolo_pascal, int() truncation included
+        return yolo_to_pascal(boxes, W, H)
     
     def non_max_suppression(self, boxes, iou_threshold):
-        # import pdb; pdb.set_trace()
-        boxes_copy = copy.deepcopy(boxes)
-        while(True):
-            selected_indices = []
-            removed_indices = []
-            for i in range(len(boxes_copy)):
-                if i in selected_indices or i in removed_indices:
-                   continue    
-                current_box = boxes_copy[i]
-                selected_indices.append(i)
-                for j in range(i + 1, len(boxes_copy)):
-                    if j in selected_indices or j in removed_indices:
-                        continue                    
-                    if self.calculate_iou(current_box, boxes_copy[j]) > iou_threshold:
-                        removed_indices.append(j)
-            
-            selected_indices = sorted(selected_indices)
-            # print(len(selected_indices),len(boxes_copy))
-            if(len(selected_indices)==len(boxes_copy)):
-                break
-            else:
-                boxes_copy = boxes_copy[selected_indices]
-        return boxes_copy
+        # vectorized equivalent of the original per-pair loop, see nms.py
+        return non_max_suppression(boxes, iou_threshold, backend=self.nms_backend)
                 
-    def calculate_iou(self, box1, box2):
-        x1, y1, w1, h1, c1 = box1
-        x2, y2, w2, h2, c2 = box2
-        
-        # Convert to absolute coordinates
-        x1 = x1 - w1/2; y1 = y1 - h1/2
-        x2 = x2 - w2/2; y2 = y2 - h2/2
-        
-        # Calculate intersection coordinates
-        x_intersection = max(x1, x2)
-        y_intersection = max(y1, y2)
-        w_intersection = max(0, min(x1 + w1, x2 + w2) - x_intersection)
-        h_intersection = max(0, min(y1 + h1, y2 + h2) - y_intersection)
-        
-        # Calculate intersection area
-        intersection_area = w_intersection * h_intersection
-        
-        # Calculate areas of the bounding boxes
-        area1 = w1 * h1
-        area2 = w2 * h2
-        
-        iou = intersection_area / float(area1 + area2 - intersection_area)
-        return iou
-
     def draw_boxes(self, image_paths, bounding_boxes, output_path="focalnet_dino/output_check/image_w_bounds"):
         for index, image_path in enumerate(image_paths): 
             image = cv2.imread(os.path.join(self.img_base, image_path))
@@ -289,9 +521,10 @@ if __name__=='__main__':
     print(len(dataset))
 
     batch_size = 3  
-    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+    data_loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4, collate_fn=dataset.collate)
 
-    crops, titles, labels = next(iter(data_loader))
+    batch = next(iter(data_loader))
+    crops, titles, labels = batch['crops'], batch['texts'], batch['labels']
 
     # dataset.draw_boxes(image_paths=image_paths, bounding_boxes=proposals)
     # dataset.save_images_batch_wise(all_cropped_images=crops)
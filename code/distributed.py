@@ -0,0 +1,77 @@
+import os
+from contextlib import contextmanager
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend=None):
+    # reads the environment set by torchrun; a plain `python train.py` stays a single process
+    # returns (rank, world_size, device)
+    if 'WORLD_SIZE' not in os.environ or int(os.environ['WORLD_SIZE']) < 1:
+        return 0, 1, torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if backend is None:
+        backend = 'nccl' if torch.cuda.is_available() else 'gloo'
+    if backend == 'nccl':
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+    else:
+        device = torch.device('cpu')
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size(), device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_sum(values, device):
+    # sums a list of python numbers over all processes
+    if not is_distributed():
+        return list(values)
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+
+def all_gather_object(value):
+    # [value of rank 0, value of rank 1, ...] on every process
+    if not is_distributed():
+        return [value]
+    values = [None] * dist.get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+
+@contextmanager
+def main_process_first():
+    # rank 0 builds the proposal store / token cache / mask vocab, the others then read them
+    if not is_main_process():
+        barrier()
+    yield
+    if is_main_process():
+        barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
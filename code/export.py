@@ -0,0 +1,97 @@
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from backends import load_backend
+from test import load_model_again
+
+INPUT_NAMES = ['crops', 'input_ids', 'attention_mask']
+DYNAMIC_AXES = {
+    'crops': {0: 'batch', 1: 'topk'},
+    'input_ids': {0: 'batch', 1: 'sequence'},
+    'attention_mask': {0: 'batch', 1: 'sequence'},
+    'logits': {0: 'batch'},
+}
+PROMPTS = ['Indication: screening', 'Indication: lump in the left breast for two months, family history of breast cancer']
+CHECK_PROMPTS = ['Indication: follow up of a right breast lesion', 'Indication: screening', 'Indication: nipple discharge']
+
+
+class ExportWrapper(nn.Module):
+    # the eager MMBCD forward on padded crops, logits only
+    def __init__(self, model):
+        super(ExportWrapper, self).__init__()
+        model = model.module if hasattr(model, 'module') else model
+        # the caches live on the host and chunking/checkpointing only matter for eager memory,
+        # the graph runs the plain forward (dedup is skipped while tracing)
+        model.text_cache = None
+        model.sentence_cache = None
+        model.crop_chunk_size = 0
+        model.set_grad_checkpointing(False)
+        self.model = model.eval()
+
+    def forward(self, crops, input_ids, attention_mask):
+        logits, _ = self.model(crops, input_ids, attention_mask)
+        return logits
+
+
+def example_inputs(tokenizer, batch_size, topk, img_size, channels=3, uint8_crops=False, prompts=PROMPTS, max_length=90):
+    # crops in the dataset layout: float [B, K, 3, S, S], or uint8 [B, K, 1|3, S, S] normalized in the graph
+    if uint8_crops:
+        crops = torch.randint(0, 256, (batch_size, topk, channels, img_size, img_size), dtype=torch.uint8)
+    else:
+        crops = torch.randn(batch_size, topk, 3, img_size, img_size)
+    # prompts of different lengths, so the graph sees padding
+    prompts = [prompts[i % len(prompts)] for i in range(batch_size)]
+    texts = tokenizer(prompts, padding=True, truncation=True, return_tensors='pt', max_length=max_length)
+    return crops, texts['input_ids'], texts['attention_mask']
+
+
+def export_torchscript(wrapper, inputs, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, inputs)
+    # folds the weights into the graph for inference
+    traced = torch.jit.freeze(traced.eval())
+    traced.save(path)
+
+
+def export_onnx(wrapper, inputs, path, opset_version=17):
+    with torch.no_grad():
+        torch.onnx.export(wrapper, inputs, path, input_names=INPUT_NAMES, output_names=['logits'],
+                          dynamic_axes=DYNAMIC_AXES, opset_version=opset_version, do_constant_folding=True)
+
+
+def check_parity(model, backend, inputs, atol=1e-4):
+    # eager vs exported logits and malignancy probabilities, on the same inputs
+    model.eval()
+    with torch.no_grad():
+        expected, _ = model(*inputs)
+    logits, _ = backend(*inputs)
+    logit_error = (logits.float() - expected.float()).abs().max().item()
+    prob_error = (F.softmax(logits.float(), dim=-1)[:, 1] - F.softmax(expected.float(), dim=-1)[:, 1]).abs().max().item()
+    print(f'max |logit diff| = {logit_error:.2e}, max |probability diff| = {prob_error:.2e}')
+    assert prob_error <= atol, f'exported graph differs from the eager model by {prob_error:.2e}'
+    return logit_error, prob_error
+
+
+if __name__=="__main__":
+    checkpoint_path = "./models/mmbcd/model_best.pt"
+    export_dir = "./models/mmbcd"
+    topk = 8
+    img_size = 224
+    uint8_crops = False # True for pipelines built with uint8_crops / crop_backend='roi_align'
+    channels = 3 # 1 for crop_channels=1
+
+    model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    model = model.module.cpu()
+    wrapper = ExportWrapper(model)
+
+    inputs = example_inputs(tokenizer, 2, topk, img_size, channels, uint8_crops)
+    # other batch / topk / sequence sizes than the traced ones, so the check covers the dynamic axes
+    check_inputs = example_inputs(tokenizer, 3, max(topk // 2, 1), img_size, channels, uint8_crops, CHECK_PROMPTS)
+
+    for name, export in (('model_best.ts', export_torchscript), ('model_best.onnx', export_onnx)):
+        path = os.path.join(export_dir, name)
+        print(f"Exporting {path}")
+        export(wrapper, inputs, path)
+        check_parity(model, load_backend(path), check_inputs)
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+
+VERSION = 1
+GROW_ROWS = 4096
+STORAGE = {'fp32': np.float32, 'fp16': np.float16, 'int8': np.int8}
+
+
+def crop_key(img_path, box, img_size, crop_mode):
+    # one crop: image, box coordinates, output size and how the pixels were produced
+    h = hashlib.blake2b(digest_size=8)
+    h.update(img_path.encode('utf-8'))
+    h.update(np.ascontiguousarray(box[:4], dtype=np.float32).tobytes())
+    h.update(np.int64(img_size).tobytes())
+    h.update(crop_mode.encode('utf-8'))
+    return np.frombuffer(h.digest(), dtype=np.uint64)[0] | np.uint64(1)
+
+
+class FeatureStore():
+    # append-only, memory-mapped store of frozen ViT prefix tokens, one [T, D] slot per crop key
+    # files: params.json | keys.npy (row -> key, rewritten by flush) | tokens.bin | scales.bin (int8 only)
+    # keys are written after the tokens, so an interrupted run only loses the rows since the last flush
+    # int8 slots are quantized per token (symmetric, fp16 scale)
+    def __init__(self, store_dir, num_tokens, dim, storage='fp16', namespace='', budget_gb=256):
+        assert storage in STORAGE
+        self.num_tokens = num_tokens
+        self.dim = dim
+        self.storage = storage
+        self.dtype = STORAGE[storage]
+
+        params = {'version': VERSION, 'num_tokens': num_tokens, 'dim': dim, 'storage': storage, 'namespace': namespace}
+        fingerprint = hashlib.blake2b(json.dumps(params, sort_keys=True).encode('utf-8'), digest_size=8).hexdigest()
+        self.store_dir = os.path.join(store_dir, fingerprint)
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(os.path.join(self.store_dir, 'params.json'), 'w') as f:
+            json.dump(params, f)
+
+        self.slot_bytes = num_tokens * dim * np.dtype(self.dtype).itemsize
+        self.max_rows = max(int(budget_gb * 1024**3) // self.slot_bytes, 1)
+
+        keys_path = os.path.join(self.store_dir, 'keys.npy')
+        self.keys = np.load(keys_path).tolist() if os.path.isfile(keys_path) else []
+        self.row_of = {key: row for row, key in enumerate(self.keys)}
+        self.capacity = 0
+        self.tokens = None
+        self.scales = None
+        self.open(len(self.keys))
+
+    def path(self, name):
+        return os.path.join(self.store_dir, name)
+
+    def open(self, rows):
+        # grows the files in GROW_ROWS steps and maps them again
+        capacity = max(self.capacity, -(-max(rows, 1) // GROW_ROWS) * GROW_ROWS)
+        if self.tokens is not None and capacity == self.capacity:
+            return
+        if self.tokens is not None:
+            self.tokens.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        for name, row_bytes in (('tokens.bin', self.slot_bytes), ('scales.bin', self.num_tokens * 2)):
+            if name == 'scales.bin' and self.storage != 'int8':
+                continue
+            with open(self.path(name), 'ab') as f:
+                if f.tell() < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+        self.capacity = capacity
+        self.tokens = np.memmap(self.path('tokens.bin'), dtype=self.dtype, mode='r+', shape=(capacity, self.num_tokens, self.dim))
+        if self.storage == 'int8':
+            self.scales = np.memmap(self.path('scales.bin'), dtype=np.float16, mode='r+', shape=(capacity, self.num_tokens))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get(self, keys, device='cpu'):
+        # float32 tokens [hits, T, D] on device (None without hits) and the bool hit mask [N] of keys
+        rows = np.array([self.row_of.get(key, -1) for key in np.asarray(keys, dtype=np.uint64).tolist()], dtype=np.int64)
+        hit = rows >= 0
+        if not hit.any():
+            return None, hit
+        rows = rows[hit]
+        tokens = torch.from_numpy(self.tokens[rows]).to(device, non_blocking=True)
+        if self.storage == 'int8':
+            scales = torch.from_numpy(self.scales[rows]).to(device, non_blocking=True)
+            return tokens.float() * scales.float().unsqueeze(-1), hit
+        return tokens.float(), hit
+
+    def put(self, keys, tokens):
+        # stores the rows of keys not seen yet; tokens: [N, T, D] tensor on any device
+        keys = np.asarray(keys, dtype=np.uint64).tolist()
+        new = {}
+        for offset, key in enumerate(keys):
+            if key not in self.row_of and key not in new:
+                new[key] = offset
+        new = list(new.items())[:max(self.max_rows - len(self.keys), 0)]
+        if not new:
+            return
+
+        tokens = tokens[[offset for _, offset in new]].detach().float()
+        start = len(self.keys)
+        self.open(start + len(new))
+        if self.storage == 'int8':
+            scales = (tokens.abs().amax(dim=-1).clamp(min=1e-4) / 127).half().float()
+            tokens = (tokens / scales.unsqueeze(-1)).round().clamp(-127, 127)
+            self.scales[start:start+len(new)] = scales.cpu().numpy().astype(np.float16)
+        self.tokens[start:start+len(new)] = tokens.cpu().numpy().astype(self.dtype)
+        for row, (key, _) in enumerate(new, start):
+            self.row_of[key] = row
+            self.keys.append(key)
+
+    def flush(self):
+        if self.tokens is None:
+            return
+        self.tokens.flush()
+        if self.scales is not None:
+            self.scales.flush()
+        tmp_path = self.path(f'keys.tmp{os.getpid()}.npy')
+        np.save(tmp_path, np.array(self.keys, dtype=np.uint64))
+        os.replace(tmp_path, self.path('keys.npy'))
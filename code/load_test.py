@@ -0,0 +1,77 @@
+import os
+import json
+import time
+import base64
+import urllib.request
+import urllib.error
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+
+def exam_requests(csv, img_base, text_base, send_bytes=False):
+    # one /predict body per UHID of the manifest; paths are read by the server, so it must run on this machine
+    # with img_base / text_base under its data_root
+    # unless send_bytes, which uploads the images
+    bodies = []
+    for uhid, exam in pd.read_csv(csv).groupby('UHID', sort=False):
+        views = []
+        for im_path in exam['im_path']:
+            view = {'boxes': os.path.abspath(os.path.join(text_base, im_path.rstrip(".png")+"_preds.txt"))}
+            image = os.path.abspath(os.path.join(img_base, im_path))
+            if send_bytes:
+                with open(image, 'rb') as f:
+                    view['image_base64'] = base64.b64encode(f.read()).decode('ascii')
+            else:
+                view['image'] = image
+            views.append(view)
+        bodies.append(json.dumps({'uhid': str(uhid), 'history': str(exam['text'].iloc[0]), 'views': views}).encode('utf-8'))
+    return bodies
+
+
+def post(url, body, timeout=60):
+    # -> (status, latency ms)
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            status = response.status
+    except urllib.error.HTTPError as error:
+        status = error.code
+    except (urllib.error.URLError, OSError):
+        status = 'error'
+    return status, (time.perf_counter() - start) * 1000
+
+
+def load_test(url, bodies, concurrency=16, total=512):
+    # total requests from `concurrency` closed-loop clients, cycling over the bodies
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda i: post(f'{url}/predict', bodies[i % len(bodies)]), range(total)))
+    elapsed = time.perf_counter() - start
+
+    statuses = Counter(status for status, _ in results)
+    latencies = np.array([latency for status, latency in results if status == 200])
+    print(f'{total} requests, concurrency {concurrency}, {elapsed:.1f}s, {statuses.get(200, 0) / elapsed:.1f} exams/s')
+    print(f'status: {dict(statuses)}')
+    if len(latencies):
+        print(f'latency ms: p50 {np.percentile(latencies, 50):.1f}  p95 {np.percentile(latencies, 95):.1f}  p99 {np.percentile(latencies, 99):.1f}')
+    with urllib.request.urlopen(f'{url}/metrics') as response:
+        print(json.dumps(json.loads(response.read()), indent=2))
+    return statuses, latencies
+
+
+if __name__=="__main__":
+    TEST_CSV = "sample_data/test.csv"
+    TEST_IMG_BASE = "inhouse2_DATA/Mammo_PNG"
+    TEST_TEXT_BASE = "inhouse2_DATA/Mammo_PNG_focalnet"
+
+    url = 'http://127.0.0.1:8000'
+    concurrency = 16
+    total = 512
+    send_bytes = False
+
+    bodies = exam_requests(TEST_CSV, TEST_IMG_BASE, TEST_TEXT_BASE, send_bytes)
+    load_test(url, bodies, concurrency, total)
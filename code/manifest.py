@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+
+class StringArray():
+    # read-only list of strings packed into one utf-8 buffer plus int64 offsets
+    # a handful of numpy arrays instead of millions of str objects, so forked DataLoader
+    # workers do not touch (and copy) their pages through refcount updates
+    def __init__(self, buffer, offsets, null=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.null = null
+
+    @classmethod
+    def from_list(cls, values):
+        null = np.array([isinstance(value, float) or value is None for value in values], dtype=bool)
+        encoded = [b'' if is_null else str(value).encode('utf-8') for value, is_null in zip(values, null)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8).copy()
+        return cls(buffer, offsets, null if null.any() else None)
+
+    @classmethod
+    def concatenate(cls, arrays):
+        buffer = np.concatenate([array.buffer for array in arrays]) if arrays else np.zeros(0, dtype=np.uint8)
+        offsets = [np.zeros(1, dtype=np.int64)]
+        for array in arrays:
+            offsets.append(array.offsets[1:] + offsets[-1][-1])
+        null = None
+        if any(array.null is not None for array in arrays):
+            null = np.concatenate([array.null if array.null is not None else np.zeros(len(array), dtype=bool) for array in arrays])
+        return cls(buffer, np.concatenate(offsets), null)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if self.null is not None and self.null[index]:
+            # same value pandas hands out for a missing cell
+            return float('nan')
+        return self.buffer[self.offsets[index]:self.offsets[index+1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def tolist(self):
+        return list(self)
+
+
+def arrow_strings(column):
+    column = column.cast(pa.large_string()).combine_chunks()
+    null = np.asarray(column.is_null().to_numpy(zero_copy_only=False), dtype=bool)
+    _, offsets, data = column.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64)[column.offset:column.offset + len(column) + 1]
+    buffer = np.frombuffer(data, dtype=np.uint8)[offsets[0]:offsets[-1]].copy() if data is not None else np.zeros(0, dtype=np.uint8)
+    return StringArray(buffer, offsets - offsets[0], null if null.any() else None)
+
+
+def int_labels(values, name):
+    # labels go to int8; a missing label would silently turn into an arbitrary class
+    missing = pd.isna(values)
+    if missing.any():
+        raise ValueError(f'{name} has {int(missing.sum())} missing values, every row needs a 0/1 label')
+    return np.asarray(values).astype(np.int8)
+
+
+def load_manifest(csv_path, string_columns=('im_path', 'text'), int_columns=('cancer', 'all_views_cancer'), chunksize=200000):
+    # reads only the needed columns into StringArrays and int8 arrays
+    # Arrow's multi-threaded reader when pyarrow is installed, chunked pandas otherwise
+    if isinstance(csv_path, pd.DataFrame):
+        df = csv_path
+        columns = {name: StringArray.from_list(df[name].tolist()) for name in string_columns}
+        columns.update({name: int_labels(df[name].to_numpy(), name) for name in int_columns})
+        return columns
+
+    if pa is not None:
+        convert_options = pa_csv.ConvertOptions(
+            include_columns=list(string_columns) + list(int_columns),
+            column_types={name: pa.large_string() for name in string_columns},
+            strings_can_be_null=True)
+        # quoted multi-line clinical histories, which the pandas reader accepts too
+        parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+        table = pa_csv.read_csv(csv_path, parse_options=parse_options, convert_options=convert_options)
+        columns = {name: arrow_strings(table.column(name)) for name in string_columns}
+        columns.update({name: int_labels(table.column(name).to_numpy(), name) for name in int_columns})
+        return columns
+
+    chunks = {name: [] for name in list(string_columns) + list(int_columns)}
+    dtypes = {name: str for name in string_columns}
+    for df in pd.read_csv(csv_path, usecols=list(string_columns) + list(int_columns), dtype=dtypes, chunksize=chunksize):
+        for name in string_columns:
+            chunks[name].append(StringArray.from_list(df[name].tolist()))
+        for name in int_columns:
+            chunks[name].append(int_labels(df[name].to_numpy(), name))
+    columns = {name: StringArray.concatenate(chunks[name]) for name in string_columns}
+    columns.update({name: np.concatenate(chunks[name]) if chunks[name] else np.zeros(0, dtype=np.int8) for name in int_columns})
+    return columns
@@ -2,7 +2,15 @@ import torch
 import torch.nn as nn
 import torchvision.models as models
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+import hashlib
+import threading
+from collections import OrderedDict
 from transformers import RobertaForSequenceClassification
+from precision import autocast
+
+# rows per step of the crop dedup fingerprint and check, bounds their temporary copies
+DEDUP_ROWS = 32
 
 class vit_dino(nn.Module):
     def __init__(self, layers=11, img_size=224):
@@ -29,11 +37,72 @@ class vit_dino(nn.Module):
 
         return output_tensor
 
+class CropPreprocess(nn.Module):
+    # uint8 crops [B, K, 1|3, S, S] -> float, 3 channels, ImageNet-normalized
+    def __init__(self, mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)):
+        super(CropPreprocess, self).__init__()
+        # not persistent, so checkpoints stay compatible with the float pipeline
+        self.register_buffer('mean', torch.tensor(mean).view(1, 1, 3, 1, 1), persistent=False)
+        self.register_buffer('std', torch.tensor(std).view(1, 1, 3, 1, 1), persistent=False)
+
+    def forward(self, crops):
+        crops = crops.float().div_(255)
+        if crops.shape[2] == 1:
+            crops = crops.expand(-1, -1, 3, -1, -1)
+        return (crops - self.mean) / self.std
+
+class LRUCache():
+    # tensors keyed by a prompt's unpadded token ids: frozen RoBERTa hidden states [L, 768] on the CPU,
+    # or eval sentence embeddings; shared by the DataParallel replicas, which run in threads
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __deepcopy__(self, memo):
+        # copies start empty, their weights may change (quantization, fine-tuning) and the entries go stale
+        return LRUCache(self.max_entries)
+
 class MMBCD(nn.Module):
-    def __init__(self, checkpoint_path_vit, vit_layers_freeze, vit_img_size, rob_checkpoint_path, rob_layers_unfreeze):
+    def __init__(self, checkpoint_path_vit, vit_layers_freeze, vit_img_size, rob_checkpoint_path, rob_layers_unfreeze, grad_checkpointing=False, crop_chunk_size=0, dedup_crops=False):
         super(MMBCD, self).__init__()
 
         self.img_size = vit_img_size
+        self.vit_layers_freeze = vit_layers_freeze
+        self.rob_layers_unfreeze = rob_layers_unfreeze
+        self.text_cache = None
+        self.sentence_cache = None
+        # crops per ViT call, 0 runs all batch_size*topk crops at once
+        self.crop_chunk_size = crop_chunk_size
+        # identical crops (padding duplicates, repeated boxes) go through the ViT once
+        self.dedup_crops = dedup_crops
+        self.fingerprint_weights = {}
+        self.preprocess = CropPreprocess()
+        # autocast precision of the forward, see precision.set_precision
+        self.precision = 'fp32'
 
         ## Loading image model 
         model_image = vit_dino(vit_layers_freeze, vit_img_size)
@@ -101,26 +170,295 @@ class MMBCD(nn.Module):
         in_features = 256
         self.attention = nn.MultiheadAttention(embed_dim=in_features, num_heads=1, batch_first = True, dropout=0.3)
         self.model_fc2 = nn.Linear(in_features*3, 2)
-        
-    def forward(self, image_tensor, inputids, attmask):
-        x = image_tensor.view(-1, 3, self.img_size, self.img_size)
-        features = self.image_encoder(x)
+
+        self.grad_checkpointing = False
+        if grad_checkpointing:
+            self.set_grad_checkpointing(True)
+
+    def set_grad_checkpointing(self, enable=True):
+        # recompute block activations in backward instead of storing them, for the ViT blocks and RoBERTa layers
+        self.grad_checkpointing = enable
+        if enable:
+            self.text_encoder.gradient_checkpointing_enable(gradient_checkpointing_kwargs={'use_reentrant': False})
+        else:
+            self.text_encoder.gradient_checkpointing_disable()
+
+    def vit_features(self, x):
+        if not (self.grad_checkpointing and self.training and torch.is_grad_enabled()):
+            return self.image_encoder(x)
+
+        # same computation as the DINO VisionTransformer forward, block by block
+        vit = self.image_encoder
+        x = vit.prepare_tokens(x)
+        for block in vit.blocks:
+            # cls_token/pos_embed are trainable, so frozen blocks also sit on the gradient path
+            if x.requires_grad or any(param.requires_grad for param in block.parameters()):
+                x = checkpoint(block, x, use_reentrant=False)
+            else:
+                x = block(x)
+        x = vit.norm(x)
+        return x[:, 0]
+
+    def freeze_prefix(self):
+        # cls_token/pos_embed are added before the first block, the prefix output is only
+        # a fixed function of the crop once they are frozen as well
+        self.image_encoder.cls_token.requires_grad = False
+        self.image_encoder.pos_embed.requires_grad = False
+
+    def prefix_fingerprint(self):
+        # identifies the frozen prefix weights, a different ViT checkpoint gets its own feature store
+        vit = self.image_encoder
+        h = hashlib.blake2b(digest_size=8)
+        h.update(str((self.img_size, self.vit_layers_freeze)).encode('utf-8'))
+        prefix = [vit.cls_token, vit.pos_embed] + list(vit.patch_embed.parameters()) + list(vit.blocks[:self.vit_layers_freeze].parameters())
+        for param in prefix:
+            h.update(param.detach().float().cpu().numpy().tobytes())
+        return h.hexdigest()
+
+    def prefix_tokens(self, x):
+        # patch embedding and the frozen blocks, [N, T, 384]
+        vit = self.image_encoder
+        with torch.no_grad():
+            x = vit.prepare_tokens(x)
+            for block in vit.blocks[:self.vit_layers_freeze]:
+                x = block(x)
+        return x
+
+    def suffix_features(self, x):
+        # trainable blocks and the final norm from prefix tokens, cls features [N, 384]
+        vit = self.image_encoder
+        checkpointing = self.grad_checkpointing and self.training and torch.is_grad_enabled()
+        for block in vit.blocks[self.vit_layers_freeze:]:
+            x = checkpoint(block, x, use_reentrant=False) if checkpointing else block(x)
+        x = vit.norm(x)
+        return x[:, 0]
+
+    def enable_text_cache(self, max_entries=20000):
+        # the embeddings and frozen RoBERTa layers then run once per distinct prompt, in eval mode
+        self.text_cache = LRUCache(max_entries) if max_entries > 0 else None
+
+    def enable_sentence_cache(self, max_entries=20000):
+        # eval-mode sentence embeddings, cleared whenever the model goes back to training
+        self.sentence_cache = LRUCache(max_entries) if max_entries > 0 else None
+
+    def train(self, mode=True):
+        if mode and self.sentence_cache is not None:
+            self.sentence_cache.clear()
+        return super(MMBCD, self).train(mode)
+
+    def frozen_text_layers(self):
+        layers = self.text_encoder.roberta.encoder.layer
+        # mirrors the layer[-rob_layers_unfreeze:] slice used to unfreeze them (0 unfreezes all)
+        return len(layers) - len(layers[-self.rob_layers_unfreeze:])
+
+    def additive_mask(self, attmask, dtype):
+        # [B, 1, 1, L] mask added to the attention scores, as RoBERTa builds it for eager/sdpa attention
+        return (1.0 - attmask[:, None, None, :].to(dtype)) * torch.finfo(dtype).min
+
+    def run_text_layers(self, hidden, mask, layers, checkpointing=False):
+        for layer in layers:
+            # layers that checkpoint themselves (newer transformers) are called directly
+            if checkpointing and not getattr(layer, 'gradient_checkpointing', False):
+                hidden = checkpoint(layer, hidden, mask, use_reentrant=False)
+            else:
+                hidden = layer(hidden, mask)
+            hidden = hidden[0] if isinstance(hidden, tuple) else hidden
+        return hidden
+
+    def text_prefix(self, inputids, attmask):
+        # hidden states after the frozen layers [B, L, 768], padded positions left at zero
+        roberta = self.text_encoder.roberta
+        n_frozen = self.frozen_text_layers()
+        lengths = attmask.sum(1).tolist()
+        ids = inputids.cpu().numpy()
+        keys = [ids[row, :length].tobytes() for row, length in enumerate(lengths)]
+        cached = [self.text_cache.get(key) for key in keys]
+
+        missing = [row for row, value in enumerate(cached) if value is None]
+        if missing:
+            modules = [roberta.embeddings] + list(roberta.encoder.layer[:n_frozen])
+            modes = [module.training for module in modules]
+            for module in modules:
+                module.eval()
+            with torch.no_grad():
+                hidden = roberta.embeddings(input_ids=inputids[missing])
+                mask = self.additive_mask(attmask[missing], hidden.dtype)
+                hidden = self.run_text_layers(hidden, mask, roberta.encoder.layer[:n_frozen])
+            for module, mode in zip(modules, modes):
+                module.train(mode)
+            for offset, row in enumerate(missing):
+                cached[row] = hidden[offset, :lengths[row]].cpu()
+                self.text_cache.put(keys[row], cached[row])
+
+        prefix = torch.zeros(inputids.shape + (cached[0].shape[-1],), dtype=cached[0].dtype, device=inputids.device)
+        for row, value in enumerate(cached):
+            prefix[row, :lengths[row]] = value.to(inputids.device, non_blocking=True)
+        return prefix
+
+    def text_features(self, inputids, attmask):
+        # sentence embedding: last hidden state of <s>
+        if self.text_cache is None:
+            text_embedd = self.text_encoder(input_ids=inputids, attention_mask=attmask)
+            return text_embedd.hidden_states[-1][:,0,:]
+
+        roberta = self.text_encoder.roberta
+        hidden = self.text_prefix(inputids, attmask)
+        mask = self.additive_mask(attmask, hidden.dtype)
+        checkpointing = self.grad_checkpointing and self.training and torch.is_grad_enabled()
+        hidden = self.run_text_layers(hidden, mask, roberta.encoder.layer[self.frozen_text_layers():], checkpointing)
+        return hidden[:, 0, :]
+
+    def cached_text_features(self, inputids, attmask):
+        if self.sentence_cache is None or self.training or torch.is_grad_enabled():
+            return self.text_features(inputids, attmask)
+
+        lengths = attmask.sum(1).tolist()
+        ids = inputids.cpu().numpy()
+        keys = [ids[row, :length].tobytes() for row, length in enumerate(lengths)]
+        cached = [self.sentence_cache.get(key) for key in keys]
+        missing = [row for row, value in enumerate(cached) if value is None]
+        if missing:
+            # trims the padding the cached rows needed
+            length = max(lengths[row] for row in missing)
+            features = self.text_features(inputids[missing, :length], attmask[missing, :length])
+            for offset, row in enumerate(missing):
+                cached[row] = features[offset].clone()
+                self.sentence_cache.put(keys[row], cached[row])
+        return torch.stack([value.to(inputids.device) for value in cached])
+
+    def encode_text(self, inputids, attmask):
+        # identical prompts (e.g. every view of an exam) go through RoBERTa once and are gathered back,
+        # before txt_fc_layer so its BatchNorm still sees every row
+        # not while tracing for export, where the branch would be frozen into the graph
+        if torch.jit.is_tracing():
+            return self.cached_text_features(inputids, attmask)
+        rows = torch.cat([inputids, attmask], dim=1)
+        unique, inverse = torch.unique(rows, dim=0, return_inverse=True)
+        if len(unique) == len(rows):
+            return self.cached_text_features(inputids, attmask)
+        return self.cached_text_features(unique[:, :inputids.shape[1]], unique[:, inputids.shape[1]:])[inverse]
+
+    def unique_crops(self, x):
+        # x: [N, ...] crops or prefix tokens -> (unique rows, inverse) or (x, None) without duplicates
+        # rows are grouped by a random projection and every row is verified to be bit-identical to the
+        # first row of its group; a row that is not keeps its own slot, so a fingerprint collision only
+        # costs the dedup of that row, never correctness
+        flat = x.reshape(len(x), -1)
+        key = (flat.shape[1], flat.device)
+        if key not in self.fingerprint_weights:
+            generator = torch.Generator().manual_seed(0)
+            self.fingerprint_weights[key] = torch.rand(flat.shape[1], 2, generator=generator, dtype=torch.float64).to(flat.device)
+        # float64 outside the caller's autocast (fp16 overflows on uint8 crops, bf16 collides distinct
+        # ones), a few rows at a time so the copies stay small next to the batch
+        fingerprint = flat.new_empty((len(flat), 2), dtype=torch.float64)
+        with torch.autocast(flat.device.type, enabled=False):
+            for start in range(0, len(flat), DEDUP_ROWS):
+                fingerprint[start:start+DEDUP_ROWS] = flat[start:start+DEDUP_ROWS].double() @ self.fingerprint_weights[key]
+        unique, inverse = torch.unique(fingerprint, dim=0, return_inverse=True)
+        if len(unique) == len(x):
+            return x, None
+        first = torch.full((len(unique),), len(x), dtype=torch.long, device=x.device)
+        first = first.scatter_reduce(0, inverse, torch.arange(len(x), device=x.device), reduce='amin')
+        source = first[inverse]
+        collided = torch.cat([(flat[start:start+DEDUP_ROWS] != flat[source[start:start+DEDUP_ROWS]]).any(dim=1) for start in range(0, len(flat), DEDUP_ROWS)])
+        collided = collided.nonzero().squeeze(1)
+        if len(collided):
+            inverse = inverse.clone()
+            inverse[collided] = torch.arange(len(first), len(first) + len(collided), device=x.device)
+            first = torch.cat([first, collided])
+            if len(first) == len(x):
+                return x, None
+        return x[first], inverse
+
+    def chunked(self, function, x):
+        # chunking bounds the size of the per-call attention maps ([crops, heads, 785, 785] at 224px)
+        chunk_size = self.crop_chunk_size if self.crop_chunk_size > 0 else len(x)
+        if chunk_size >= len(x):
+            return function(x)
+        return torch.cat([function(x[start:start+chunk_size]) for start in range(0, len(x), chunk_size)])
+
+    def encode_crops(self, x):
+        return self.chunked(self.vit_features, x)
+
+    def crop_pixels(self, x):
+        # uint8 crops are normalized on the device, [N, 3, S, S]
+        if x.dtype == torch.uint8:
+            x = self.preprocess(x.unsqueeze(1)).squeeze(1)
+        return x.reshape(-1, 3, self.img_size, self.img_size)
+
+    def forward(self, image_tensor, inputids, attmask, roi_mask=None, from_prefix=False, return_prefix=False, return_attention=False, prefix=None, prefix_mask=None):
+        # autocast is entered here rather than by the caller, so every DataParallel replica gets the dtype
+        with autocast(image_tensor.device, self.precision):
+            return self.run_forward(image_tensor, inputids, attmask, roi_mask, from_prefix, return_prefix, return_attention, prefix, prefix_mask)
+
+    def run_forward(self, image_tensor, inputids, attmask, roi_mask=None, from_prefix=False, return_prefix=False, return_attention=False, prefix=None, prefix_mask=None):
+        # roi_mask: [B, K] bool of the real crops when images carry fewer than K proposals; only those
+        #   go through the ViT, the padded slots are ignored by the attention and the max-pool
+        # from_prefix: image_tensor holds stored prefix tokens [B, K, T, 384] instead of crops
+        # return_prefix: also returns the prefix tokens computed for the crops, for the feature store
+        #   ([B, K, T, 384], or [real crops, T, 384] in roi_mask order)
+        # return_attention: also returns the text-to-crop attention weights [B, K], after the prefix
+        # prefix, prefix_mask: stored prefix tokens [B, K, T, 384] for the crops where prefix_mask [B, K]
+        #   is set; only the other crops go through the frozen prefix
+        B, K = image_tensor.shape[:2]
+        x = image_tensor[roi_mask] if roi_mask is not None else image_tensor.reshape(-1, *image_tensor.shape[2:])
+
+        if prefix is not None:
+            known = prefix_mask[roi_mask] if roi_mask is not None else prefix_mask.reshape(-1)
+            stored = prefix[roi_mask] if roi_mask is not None else prefix.reshape(-1, *prefix.shape[2:])
+            if not known.all():
+                stored = stored.clone()
+                stored[~known] = self.chunked(self.prefix_tokens, self.crop_pixels(x[~known])).to(stored.dtype)
+            x = stored
+            from_prefix = True
+
+        inverse = None
+        if self.dedup_crops and not torch.jit.is_tracing():
+            x, inverse = self.unique_crops(x)
+
+        prefix = None
+        if from_prefix:
+            features = self.chunked(self.suffix_features, x)
+            if return_prefix:
+                prefix = x
+        else:
+            x = self.crop_pixels(x)
+            if return_prefix:
+                prefix = self.chunked(self.prefix_tokens, x)
+                features = self.chunked(self.suffix_features, prefix)
+            else:
+                features = self.encode_crops(x)
         features = features.squeeze(-1).squeeze(-1)
 
-        image_embeddings = self.img_fc_layer(features)
-        image_embeddings = image_embeddings.view(image_tensor.shape[0], image_tensor.shape[1], -1)
-        maxpool_img_embedd, _ = torch.max(image_embeddings, dim=1)
-        tokenized_sentences = {'input_ids': inputids, 'attention_mask': attmask}
-        text_embedd = self.text_encoder(**tokenized_sentences)
+        if inverse is not None:
+            # gathered back before img_fc_layer, whose BatchNorm sees every crop as before;
+            # the backward of the gather sums the gradients of the copies into their unique crop
+            features = features[inverse]
+            prefix = prefix[inverse] if prefix is not None else None
 
-        sentence_embeddings = text_embedd.hidden_states[-1][:,0,:]
+        image_embeddings = self.img_fc_layer(features)
+        if roi_mask is not None:
+            image_embeddings = image_embeddings.new_zeros(B, K, image_embeddings.shape[-1]).masked_scatter(roi_mask.unsqueeze(-1), image_embeddings)
+            maxpool_img_embedd, _ = torch.max(image_embeddings.masked_fill(~roi_mask.unsqueeze(-1), float('-inf')), dim=1)
+        else:
+            image_embeddings = image_embeddings.view(B, K, -1)
+            maxpool_img_embedd, _ = torch.max(image_embeddings, dim=1)
+        sentence_embeddings = self.encode_text(inputids, attmask)
         text_embeddings = self.txt_fc_layer(sentence_embeddings)
 
-        attn_features, attn_weights = self.attention(text_embeddings.unsqueeze(1), image_embeddings, image_embeddings)        
+        key_padding_mask = ~roi_mask if roi_mask is not None else None
+        attn_features, attn_weights = self.attention(text_embeddings.unsqueeze(1), image_embeddings, image_embeddings, key_padding_mask=key_padding_mask)        
         embeddings_org = torch.cat((attn_features.squeeze(1), text_embeddings, maxpool_img_embedd), dim=1)
         embeddings = self.model_fc2(embeddings_org.squeeze(1))
 
-        return embeddings, embeddings_org
+        outputs = (embeddings, embeddings_org)
+        if return_prefix:
+            if roi_mask is None:
+                prefix = prefix.view(B, K, *prefix.shape[1:])
+            outputs += (prefix,)
+        if return_attention:
+            outputs += (attn_weights.squeeze(1),)
+        return outputs
     
     def remove_module_prefix(self, state_dict):
         new_state_dict = {}
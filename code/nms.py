@@ -0,0 +1,86 @@
+import numpy as np
+import torch
+
+
+def box_iou_matrix(boxes, backend='numpy', device='cpu'):
+    # boxes: [..., N, 5] in (cx, cy, w, h, conf); same arithmetic as the original per-pair all_mammo.calculate_iou
+    if backend == 'torch':
+        boxes = torch.as_tensor(boxes, dtype=torch.float32, device=device)
+        maximum, minimum = torch.maximum, torch.minimum
+    else:
+        boxes = np.asarray(boxes, dtype=np.float32)
+        maximum, minimum = np.maximum, np.minimum
+
+    w = boxes[..., 2]; h = boxes[..., 3]
+    x1 = boxes[..., 0] - w/2; y1 = boxes[..., 1] - h/2
+    x2 = x1 + w; y2 = y1 + h
+
+    x_intersection = maximum(x1[..., :, None], x1[..., None, :])
+    y_intersection = maximum(y1[..., :, None], y1[..., None, :])
+    w_intersection = (minimum(x2[..., :, None], x2[..., None, :]) - x_intersection).clip(min=0)
+    h_intersection = (minimum(y2[..., :, None], y2[..., None, :]) - y_intersection).clip(min=0)
+    intersection_area = w_intersection * h_intersection
+
+    area = w * h
+    union = area[..., :, None] + area[..., None, :] - intersection_area
+
+    # the loop version divides in float64, keep that for identical threshold decisions
+    if backend == 'torch':
+        return intersection_area.double() / union.double()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intersection_area.astype(np.float64) / union.astype(np.float64)
+
+
+def greedy_keep(iou, iou_threshold, valid=None):
+    # iou: [B, N, N]; boxes are visited in file order, a box is kept unless an earlier kept box overlaps it
+    if isinstance(iou, torch.Tensor):
+        suppressed = torch.zeros(iou.shape[:2], dtype=torch.bool, device=iou.device)
+        if valid is not None:
+            suppressed |= ~torch.as_tensor(valid, dtype=torch.bool, device=iou.device)
+        overlaps = iou > iou_threshold
+    else:
+        suppressed = np.zeros(iou.shape[:2], dtype=bool)
+        if valid is not None:
+            suppressed |= ~np.asarray(valid, dtype=bool)
+        overlaps = iou > iou_threshold
+
+    for i in range(iou.shape[1] - 1):
+        active = ~suppressed[:, i]
+        suppressed[:, i+1:] |= overlaps[:, i, i+1:] & active[:, None]
+
+    return ~suppressed
+
+
+def non_max_suppression(boxes, iou_threshold, backend='numpy', device='cpu'):
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+    if len(boxes) == 0:
+        return boxes
+
+    iou = box_iou_matrix(boxes[None], backend=backend, device=device)
+    keep = greedy_keep(iou, iou_threshold)[0]
+    if backend == 'torch':
+        keep = keep.cpu().numpy()
+    return boxes[keep]
+
+
+def batched_non_max_suppression(boxes_list, iou_threshold, backend='numpy', device='cpu', chunk_size=64):
+    # pads a chunk of images to the same box count and suppresses all of them in one pass
+    boxes_list = [np.asarray(boxes, dtype=np.float32).reshape(-1, 5) for boxes in boxes_list]
+    kept = []
+    for start in range(0, len(boxes_list), chunk_size):
+        chunk = boxes_list[start:start+chunk_size]
+        counts = np.array([len(boxes) for boxes in chunk])
+        n_max = max(int(counts.max()), 1)
+
+        padded = np.zeros((len(chunk), n_max, 5), dtype=np.float32)
+        for index, boxes in enumerate(chunk):
+            padded[index, :len(boxes)] = boxes
+        valid = np.arange(n_max)[None, :] < counts[:, None]
+
+        iou = box_iou_matrix(padded, backend=backend, device=device)
+        keep = greedy_keep(iou, iou_threshold, valid=valid)
+        if backend == 'torch':
+            keep = keep.cpu().numpy()
+
+        kept.extend(boxes[keep[index, :len(boxes)]] for index, boxes in enumerate(chunk))
+    return kept
@@ -0,0 +1,32 @@
+from contextlib import nullcontext
+import torch
+from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
+
+DTYPES = {'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def autocast(device, precision='fp32'):
+    # mixed precision for the whole MMBCD forward (ViT, RoBERTa and the attention head)
+    # matmuls run in bf16/fp16, autocast keeps softmax, layer norm and the loss in fp32
+    if precision == 'fp32':
+        return nullcontext()
+    device_type = torch.device(device).type
+    if device_type == 'cpu' and precision == 'fp16':
+        raise ValueError('fp16 autocast needs a GPU, use --precision bf16 on CPU')
+    return torch.autocast(device_type, dtype=DTYPES[precision])
+
+
+def grad_scaler(device, precision='fp32'):
+    # fp16 gradients underflow without loss scaling, bf16 has the fp32 exponent range and needs none
+    enabled = precision == 'fp16' and torch.device(device).type == 'cuda'
+    # torch.amp.GradScaler only exists from torch 2.3, the repo pins 2.1
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def set_precision(model, precision='fp32'):
+    # MMBCD enters autocast in its own forward: nn.DataParallel replicas run in threads that re-enter
+    # torch 2.1's torch.cuda.amp.autocast, which drops the dtype and would run bf16 in fp16
+    module = model.module if isinstance(model, (DataParallel, DistributedDataParallel)) else model
+    if hasattr(module, 'precision'):
+        module.precision = precision
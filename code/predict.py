@@ -0,0 +1,123 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+from nms import non_max_suppression
+from data import yolo_to_pascal, pad_crops
+from precision import autocast
+from test import load_model_again
+
+
+class ExamPredictor():
+    # exam-level inference: one clinical history and every view of a UHID
+    # the history is tokenized once and encoded once (MMBCD.encode_text collapses the repeated rows),
+    # the crops of all views go through the ViT in a single call
+    # predict_batch does the same for several prepared exams at once (serve.py)
+    def __init__(self, model, tokenizer, img_size=224, topk=5, iou_threshold=0.1, precision='fp32', max_length=90, mode='RGB'):
+        # DataParallel/DDP wrappers are not needed for one exam
+        self.model = model.module if hasattr(model, 'module') else model
+        self.model.eval()
+        self.device = next(self.model.parameters()).device
+        self.tokenizer = tokenizer
+        self.img_size = img_size
+        self.topk = topk
+        self.iou_threshold = iou_threshold
+        self.precision = precision
+        self.max_length = max_length
+        # 'RGB' matches the default dataset crops, 'L' the single-channel ones (roi_align / uint8_crops)
+        self.mode = mode
+        self.resize = transforms.Resize((img_size, img_size))
+
+    def proposals(self, boxes):
+        # detector output [N, 5] or the path of its txt file -> top-k NMS boxes
+        if isinstance(boxes, str):
+            boxes = np.loadtxt(boxes, dtype=np.float32)
+        proposals = non_max_suppression(boxes, self.iou_threshold)[:self.topk]
+        assert len(proposals) > 0, 'no proposals for a view'
+        # short views keep only their real boxes, the padded slots are masked in the model (roi_mask)
+        return proposals
+
+    def crops(self, image, proposals):
+        # uint8 [K, C, S, S]; CropPreprocess in the model normalizes them
+        if isinstance(image, str):
+            image = Image.open(image)
+        image = image.convert(self.mode)
+        boxes = yolo_to_pascal(proposals[:, :4], *image.size)
+        crops = [np.asarray(self.resize(image.crop(tuple(box)))) for box in boxes.tolist()]
+        crops = np.stack(crops)
+        if crops.ndim == 3:
+            return crops[:, None]
+        return crops.transpose(0, 3, 1, 2)
+
+    def tokenize(self, histories):
+        # the label-free form of all_mammo.create_valid_prompt
+        prompts = [' '.join(f'Indication: {history}'.split()) for history in histories]
+        return self.tokenizer(prompts, padding=True, truncation=True, return_tensors='pt', max_length=self.max_length)
+
+    def prepare(self, uhid, images, proposals, history):
+        # the CPU side of one exam, independent of the model
+        # images: one path or PIL image per view; proposals: one [N, 5] array or txt path per view
+        proposals = [self.proposals(boxes) for boxes in proposals]
+        crops = [torch.from_numpy(self.crops(image, boxes)) for image, boxes in zip(images, proposals)]
+        images = [image if isinstance(image, str) else None for image in images]
+        return {'uhid': uhid, 'images': images, 'proposals': proposals, 'crops': crops, 'history': history}
+
+    @torch.no_grad()
+    def predict_batch(self, exams, return_attention=False):
+        # prepared exams -> one result per exam, from a single forward over all their views
+        counts = torch.tensor([len(exam['crops']) for exam in exams])
+        crops = [crop for exam in exams for crop in exam['crops']]
+        crops, roi_mask = pad_crops(crops)
+        crops, roi_mask = crops.to(self.device), roi_mask.to(self.device)
+        texts = self.tokenize([exam['history'] for exam in exams])
+        inputids = texts['input_ids'].repeat_interleave(counts, dim=0).to(self.device)
+        attmask = texts['attention_mask'].repeat_interleave(counts, dim=0).to(self.device)
+
+        with autocast(self.device, self.precision):
+            logits, _, attention = self.model(crops, inputids, attmask, roi_mask=roi_mask, return_attention=True)
+        probabilities = F.softmax(logits.float(), dim=-1)[:, 1].tolist()
+        attention = attention.float().tolist()
+
+        results = []
+        start = 0
+        for exam, count in zip(exams, counts.tolist()):
+            views = []
+            for view in range(start, start + count):
+                result = {'image': exam['images'][view - start], 'probability': probabilities[view]}
+                if return_attention:
+                    # one weight per box the view was scored with, in proposal order
+                    boxes = exam['proposals'][view - start]
+                    result['boxes'] = boxes[:, :4].tolist()
+                    result['attention'] = attention[view][:len(boxes)]
+                views.append(result)
+            # an exam is as suspicious as its most suspicious view
+            results.append({'uhid': exam['uhid'], 'views': views, 'probability': max(view['probability'] for view in views)})
+            start += count
+        return results
+
+    def predict(self, uhid, images, proposals, history, return_attention=False):
+        return self.predict_batch([self.prepare(uhid, images, proposals, history)], return_attention)[0]
+
+
+if __name__=="__main__":
+    TEST_CSV = "sample_data/test.csv"
+    TEST_IMG_BASE = "inhouse2_DATA/Mammo_PNG"
+    TEST_TEXT_BASE = "inhouse2_DATA/Mammo_PNG_focalnet"
+
+    checkpoint_path = "./models/mmbcd/model_best.pt"
+    topk = 8
+    img_size = 224
+
+    model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    predictor = ExamPredictor(model, tokenizer, img_size, topk)
+
+    df = pd.read_csv(TEST_CSV)
+    for uhid, exam in df.groupby('UHID', sort=False):
+        images = [os.path.join(TEST_IMG_BASE, im_path) for im_path in exam['im_path']]
+        proposals = [os.path.join(TEST_TEXT_BASE, im_path.rstrip(".png")+"_preds.txt") for im_path in exam['im_path']]
+        print(json.dumps(predictor.predict(uhid, images, proposals, exam['text'].iloc[0])))
@@ -0,0 +1,225 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from tqdm.auto import tqdm
+
+from nms import batched_non_max_suppression
+
+MAGIC = b'MMBCDPS1'
+VERSION = 2
+ALIGN = 64
+
+
+def missing_files(paths):
+    # one directory listing per parent folder instead of an isfile call per path
+    listings = {}
+    missing = []
+    for path in paths:
+        folder, name = os.path.split(path)
+        if folder not in listings:
+            listings[folder] = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+        if name not in listings[folder]:
+            missing.append(path)
+    return missing
+
+
+def shard(items, num_shards):
+    shard_size = -(-len(items) // max(num_shards, 1))
+    return [items[start:start+shard_size] for start in range(0, len(items), max(shard_size, 1))]
+
+
+def process_pool(workers):
+    # spawn, so the pool is safe to start while other threads (e.g. TF-IDF fitting) are running
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def build_proposals(proposal_paths, iou_threshold, topk, nms_backend='numpy', chunk_size=64, progress=True, workers=1):
+    # loads the detector output of every image and keeps the first topk boxes surviving NMS
+    if workers > 1 and len(proposal_paths) > chunk_size:
+        # several shards per worker keeps the pool busy when shards take uneven time
+        shards = shard(list(proposal_paths), workers*4)
+        with process_pool(workers) as pool:
+            results = pool.map(build_proposals, shards, repeat(iou_threshold), repeat(topk), repeat(nms_backend), repeat(chunk_size), repeat(False))
+            if progress:
+                results = tqdm(results, total=len(shards), desc='generating proposals', position=0, leave=True)
+            results = list(results)
+        return np.concatenate([boxes for boxes, _ in results]), np.concatenate([counts for _, counts in results])
+
+    missing = missing_files(proposal_paths)
+    assert len(missing) == 0, f'{len(missing)} proposal files not found, e.g. {missing[0]}'
+
+    boxes = np.zeros((len(proposal_paths), topk, 5), dtype=np.float32)
+    counts = np.zeros(len(proposal_paths), dtype=np.int32)
+
+    iterator = range(0, len(proposal_paths), chunk_size)
+    if progress:
+        iterator = tqdm(iterator, total=len(iterator), desc='generating proposals', position=0, leave=True)
+    for start in iterator:
+        chunk_boxes = [np.loadtxt(proposal_path, dtype=np.float32) for proposal_path in proposal_paths[start:start+chunk_size]]
+
+        kept = batched_non_max_suppression(chunk_boxes, iou_threshold, backend=nms_backend, chunk_size=chunk_size)
+        for offset, proposals in enumerate(kept):
+            proposals = proposals[:topk]
+            boxes[start+offset, :len(proposals)] = proposals
+            counts[start+offset] = len(proposals)
+
+    return boxes, counts
+
+
+def file_stamp(path, validate='mtime'):
+    if validate == 'hash':
+        with open(path, 'rb') as f:
+            return hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    stat = os.stat(path)
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def file_stamps(paths, validate='mtime', workers=1):
+    if workers > 1 and len(paths) > 1024:
+        with process_pool(workers) as pool:
+            return [stamp for stamps in pool.map(file_stamps, shard(paths, workers*4), repeat(validate)) for stamp in stamps]
+    return [file_stamp(path, validate) for path in paths]
+
+
+def aligned(offset):
+    return offset + (-offset) % ALIGN
+
+
+def lookup(stored_keys, keys):
+    # row of every key in stored_keys, -1 where it is absent; vectorized, no per-key dict
+    if len(keys) == len(stored_keys) and np.array_equal(keys, stored_keys):
+        # the usual case, the same manifest as the run that wrote the store
+        return np.arange(len(keys), dtype=np.int64)
+    if len(stored_keys) == 0:
+        return np.full(len(keys), -1, dtype=np.int64)
+    order = np.argsort(stored_keys, kind='stable')
+    sorted_keys = stored_keys[order]
+    position = np.searchsorted(sorted_keys, keys).clip(max=len(order) - 1)
+    return np.where(sorted_keys[position] == keys, order[position], -1).astype(np.int64)
+
+
+class ProposalStore():
+    # single memory-mappable file of post-NMS top-k proposals keyed by proposal file path
+    # layout: MAGIC | uint64 header length | JSON header | keys S[key_width] [N] | stamps S[stamp_width] [N]
+    #         | boxes float32 [N, topk, 5] | counts int32 [N], every array starting on an ALIGN boundary
+    # the header only holds the params and the array shapes, so opening the store does not grow with N
+    # a change of iou_threshold/topk/validate discards the store, a changed file stamp recomputes that entry
+    def __init__(self, store_path, iou_threshold, topk, validate='mtime', nms_backend='numpy', workers=1):
+        assert validate in ('mtime', 'hash')
+        self.store_path = store_path
+        self.iou_threshold = float(iou_threshold)
+        self.topk = int(topk)
+        self.validate = validate
+        self.nms_backend = nms_backend
+        self.workers = workers
+
+    def params(self):
+        return {'version': VERSION, 'iou_threshold': self.iou_threshold, 'topk': self.topk, 'validate': self.validate}
+
+    def section_offsets(self, n, key_width, stamp_width, data_offset):
+        keys_offset = data_offset
+        stamps_offset = aligned(keys_offset + n * key_width)
+        boxes_offset = aligned(stamps_offset + n * stamp_width)
+        counts_offset = aligned(boxes_offset + n * self.topk * 5 * 4)
+        return keys_offset, stamps_offset, boxes_offset, counts_offset
+
+    def empty(self):
+        return np.zeros(0, dtype='S1'), np.zeros(0, dtype='S1'), np.zeros((0, self.topk, 5), dtype=np.float32), np.zeros(0, dtype=np.int32)
+
+    def read(self):
+        if not os.path.isfile(self.store_path):
+            return None
+        with open(self.store_path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        if header['params'] != self.params():
+            return None
+
+        n = header['n']
+        if n == 0:
+            return self.empty()
+        keys_offset, stamps_offset, boxes_offset, counts_offset = self.section_offsets(n, header['key_width'], header['stamp_width'], header['data_offset'])
+        keys = np.memmap(self.store_path, dtype=f'S{header["key_width"]}', mode='r', offset=keys_offset, shape=(n,))
+        stamps = np.memmap(self.store_path, dtype=f'S{header["stamp_width"]}', mode='r', offset=stamps_offset, shape=(n,))
+        boxes = np.memmap(self.store_path, dtype=np.float32, mode='r', offset=boxes_offset, shape=(n, self.topk, 5))
+        counts = np.memmap(self.store_path, dtype=np.int32, mode='r', offset=counts_offset, shape=(n,))
+        return keys, stamps, boxes, counts
+
+    def write(self, keys, stamps, boxes, counts):
+        header = {'params': self.params(), 'n': len(keys), 'key_width': keys.itemsize, 'stamp_width': stamps.itemsize, 'data_offset': 0}
+        # the header stores its own data offset, so size it with a placeholder first
+        data_offset = aligned(len(MAGIC) + 8 + len(json.dumps(header).encode('utf-8')) + 32)
+        header['data_offset'] = data_offset
+        header = json.dumps(header).encode('utf-8').ljust(data_offset - len(MAGIC) - 8)
+        offsets = self.section_offsets(len(keys), keys.itemsize, stamps.itemsize, data_offset)
+
+        tmp_path = self.store_path + f'.tmp{os.getpid()}'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            arrays = [keys, stamps, np.asarray(boxes, dtype=np.float32), np.asarray(counts, dtype=np.int32)]
+            for offset, array in zip(offsets, arrays):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(np.ascontiguousarray(array).tobytes())
+        os.replace(tmp_path, self.store_path)
+
+    def fetch(self, proposal_paths):
+        # returns boxes [N, topk, 5] and counts [N] for proposal_paths, compiling whatever is missing or stale
+        keys = np.array([os.path.abspath(path).encode('utf-8') for path in proposal_paths], dtype=bytes)
+        stamps = np.array([stamp.encode('utf-8') for stamp in file_stamps([os.path.abspath(path) for path in proposal_paths], self.validate, self.workers)], dtype=bytes)
+        if len(keys) == 0:
+            keys, stamps = np.zeros(0, dtype='S1'), np.zeros(0, dtype='S1')
+
+        stored = self.read()
+        stored_keys, stored_stamps, stored_boxes, stored_counts = stored if stored is not None else self.empty()
+
+        found = lookup(stored_keys, keys)
+        rows = found.copy()
+        stale = found >= 0
+        stale[stale] = stored_stamps[found[stale]] != stamps[stale]
+        rows[stale] = -1
+        missing = np.where(rows < 0)[0]
+
+        if len(missing) == 0:
+            if len(rows) == len(stored_keys) and np.array_equal(rows, np.arange(len(rows))):
+                return stored_boxes, stored_counts
+            return stored_boxes[rows], stored_counts[rows]
+
+        new_boxes, new_counts = build_proposals([keys[i].decode('utf-8') for i in missing], self.iou_threshold, self.topk, self.nms_backend, workers=self.workers)
+
+        # merge: refreshed entries overwrite their old rows, unseen keys are appended once each
+        all_keys = np.array(stored_keys, dtype=np.result_type(stored_keys, keys))
+        all_stamps = np.array(stored_stamps, dtype=np.result_type(stored_stamps, stamps))
+        all_boxes = np.array(stored_boxes); all_counts = np.array(stored_counts)
+
+        refreshed = found[missing] >= 0
+        old_rows = found[missing][refreshed]
+        all_boxes[old_rows] = new_boxes[refreshed]
+        all_counts[old_rows] = new_counts[refreshed]
+        all_stamps[old_rows] = stamps[missing][refreshed]
+        rows[missing[refreshed]] = old_rows
+
+        appended = missing[~refreshed]
+        if len(appended):
+            unseen, first, inverse = np.unique(keys[appended], return_index=True, return_inverse=True)
+            rows[appended] = len(all_keys) + inverse.reshape(-1)
+            all_keys = np.concatenate([all_keys, unseen])
+            all_stamps = np.concatenate([all_stamps, stamps[appended][first]])
+            all_boxes = np.concatenate([all_boxes, new_boxes[~refreshed][first]])
+            all_counts = np.concatenate([all_counts, new_counts[~refreshed][first].astype(np.int32)])
+
+        self.write(all_keys, all_stamps, all_boxes, all_counts)
+        return self.fetch_rows(rows)
+
+    def fetch_rows(self, rows):
+        _, _, boxes, counts = self.read()
+        if len(rows) == len(boxes) and np.array_equal(rows, np.arange(len(rows))):
+            return boxes, counts
+        return boxes[rows], counts[rows]
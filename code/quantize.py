@@ -0,0 +1,128 @@
+import io
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+
+from data import batch_inputs
+from test import load_data, load_model_again, test_code
+
+# one quantization unit per transformer block, the heads are single units
+GROUP_PREFIXES = ('image_encoder.blocks.', 'text_encoder.roberta.encoder.layer.')
+
+
+def linear_groups(model):
+    # group name -> names of its nn.Linear modules; a shared module (img_fc1 also sits in img_fc_layer)
+    # is listed under all its names in the group of the first one, quantize_dynamic matches qconfigs by name
+    groups = {}
+    group_of = {}
+    for name, module in model.named_modules(remove_duplicate=False):
+        if type(module) != nn.Linear:
+            continue
+        group = name.split('.')[0]
+        for prefix in GROUP_PREFIXES:
+            if name.startswith(prefix):
+                group = prefix + name[len(prefix):].split('.')[0]
+        group = group_of.setdefault(id(module), group)
+        groups.setdefault(group, []).append(name)
+    return groups
+
+
+def quantize(model, names=None):
+    # int8 dynamic quantization (int8 weights, activations quantized per batch) of the given
+    # nn.Linear modules, all of them by default; returns a quantized CPU copy
+    model = copy.deepcopy(model).cpu().eval()
+    if names is None:
+        names = [name for group in linear_groups(model).values() for name in group]
+    return torch.ao.quantization.quantize_dynamic(model, set(names), dtype=torch.qint8)
+
+
+def calibration_batches(dataloader, tokenizer, num_samples=256, batch_size=32, seed=42):
+    # a fixed random sample of the manifest, as CPU model inputs
+    dataset = dataloader.dataset
+    indices = np.random.RandomState(seed).permutation(len(dataset))[:num_samples].tolist()
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False, num_workers=dataloader.num_workers, collate_fn=dataset.collate)
+    return [batch_inputs(batch, tokenizer)[:3] for batch in loader]
+
+
+@torch.no_grad()
+def probabilities(model, batches):
+    model.eval()
+    return torch.cat([F.softmax(model(*inputs)[0].float(), dim=-1)[:, 1] for inputs in batches])
+
+
+def sensitivity(model, batches):
+    # max change of the malignancy probability on the calibration sample when only one group is int8
+    reference = probabilities(model, batches)
+    drift = {}
+    for group, names in linear_groups(model).items():
+        drift[group] = (probabilities(quantize(model, names), batches) - reference).abs().max().item()
+        print(f'{group}: {drift[group]:.4f}')
+    return drift
+
+
+def calibrate(model, batches, tolerance=0.02):
+    # Linear names to quantize: every group whose own drift stays within tolerance
+    drift = sensitivity(model, batches)
+    groups = linear_groups(model)
+    skipped = [group for group in groups if drift[group] > tolerance]
+    print(f'kept in fp32: {skipped}')
+    return [name for group in groups if group not in skipped for name in groups[group]]
+
+
+@torch.no_grad()
+def latency(model, batches, repeats=3):
+    # seconds per batch, best of repeats
+    model.eval()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for inputs in batches:
+            model(*inputs)
+        times.append((time.perf_counter() - start) / len(batches))
+    return min(times)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024**2
+
+
+if __name__=="__main__":
+    TEST_CSV = "inhouse2_DATA/inhouse2_data.csv"
+    TEST_IMG_BASE = "inhouse2_DATA/Mammo_PNG"
+    TEST_TEXT_BASE = "inhouse2_DATA/Mammo_PNG_focalnet"
+
+    checkpoint_path = "./models/mmbcd/model_best.pt"
+    plot_path = './models/mmbcd/result_auc_plot_{}.png'
+    score_file = './models/mmbcd/result_scores_{}.txt'
+    num_workers = 8
+    batch_size = 32
+    topk = 8
+    img_size = 224
+    calibrate_samples = 256 # 0 quantizes every Linear without calibration
+    tolerance = 0.02 # max probability change a quantized block may cause on the calibration sample
+
+    model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    model = model.module.cpu().eval()
+    dataloader = load_data(TEST_CSV, TEST_IMG_BASE, TEST_TEXT_BASE, num_workers, batch_size, topk, img_size, tokenizer=tokenizer)
+
+    batches = calibration_batches(dataloader, tokenizer, max(calibrate_samples, batch_size), batch_size)
+    names = calibrate(model, batches, tolerance) if calibrate_samples > 0 else None
+    quantized = quantize(model, names)
+
+    results = {}
+    for name, candidate in (('fp32', model), ('int8', quantized)):
+        print(f"Testing {name}: ")
+        metrics = test_code(candidate, tokenizer, dataloader, plot_path.format(name), score_file.format(name), device='cpu')
+        metrics['latency_s_per_batch'] = latency(candidate, batches[:4])
+        metrics['size_mb'] = model_size_mb(candidate)
+        results[name] = metrics
+
+    print(f"{'':22}{'fp32':>10}{'int8':>10}")
+    for metric in results['fp32']:
+        print(f"{metric:22}{results['fp32'][metric]:10.3f}{results['int8'][metric]:10.3f}")
@@ -0,0 +1,100 @@
+import itertools
+import numpy as np
+import torch
+from torch.utils.data.sampler import Sampler
+
+
+class BucketedWeightedBatchSampler(Sampler):
+    # draws num_samples indices exactly like WeightedRandomSampler(weights, num_samples, replacement=True),
+    # then groups every pool of bucket_batches*batch_size draws by prompt length before cutting batches,
+    # so each batch pads to a similar length while the class balance of the draw is untouched
+    # with num_replicas > 1 every rank draws the same global epoch and keeps every num_replicas-th batch
+    def __init__(self, weights, lengths, batch_size, num_samples, bucket_batches=50, drop_last=True, seed=42, num_replicas=1, rank=0):
+        self.weights = torch.as_tensor(weights, dtype=torch.double).cpu()
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.num_samples = num_samples
+        self.bucket_batches = bucket_batches
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def num_batches(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return -(-self.num_samples // self.batch_size)
+
+    def __len__(self):
+        # ranks always get the same number of batches, otherwise DDP would wait on a missing all-reduce
+        return self.num_batches() // self.num_replicas
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(self.weights, self.num_samples, replacement=True, generator=generator).numpy()
+        # draws are independent, dropping the tail keeps the last batch full without biasing lengths
+        indices = indices[:self.num_batches() * self.batch_size]
+
+        batches = []
+        pool_size = self.batch_size * self.bucket_batches
+        for start in range(0, len(indices), pool_size):
+            pool = indices[start:start+pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i+self.batch_size] for i in range(0, len(pool), self.batch_size))
+
+        # batches of all lengths are interleaved over the epoch
+        order = torch.randperm(len(batches), generator=generator).tolist()
+        for batch in order[self.rank:len(self) * self.num_replicas:self.num_replicas]:
+            yield batches[batch].tolist()
+
+
+class DistributedWeightedSampler(Sampler):
+    # WeightedRandomSampler(weights, num_samples, replacement=True) split across DDP ranks:
+    # all ranks draw the same seeded global sample for the epoch and each keeps a strided slice
+    def __init__(self, weights, num_samples, num_replicas=1, rank=0, seed=42):
+        self.weights = torch.as_tensor(weights, dtype=torch.double).cpu()
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.num_samples = num_samples // num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.multinomial(self.weights, self.num_samples * self.num_replicas, replacement=True, generator=generator)
+        return iter(indices[self.rank::self.num_replicas].tolist())
+
+
+class SkipSampler(Sampler):
+    # wraps a sampler or batch sampler; skip(n) makes its next pass start at element n (indices or
+    # batches), so a resumed epoch does not load the batches it already trained on
+    # set_epoch is forwarded, the wrapped sampler must draw the same order for an epoch again
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def skip(self, n):
+        self.start = n
+
+    def __len__(self):
+        return max(len(self.sampler) - self.start, 0)
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return itertools.islice(iter(self.sampler), start, None)
@@ -0,0 +1,195 @@
+import os
+import json
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from sklearn.metrics import accuracy_score, f1_score, roc_auc_score
+from tqdm import tqdm
+from transformers import RobertaTokenizerFast
+
+from data import all_mammo, batch_inputs, batch_roi_mask
+from precision import autocast, set_precision
+from backends import load_backend
+from test import load_model_again, recall2FPR
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Streaming, resumable batch scoring of a manifest')
+    parser.add_argument('--csv', type=str, required=True, help='Manifest (im_path, text; cancer/all_views_cancer when labeled)')
+    parser.add_argument('--img_base', type=str, required=True, help='Image directory')
+    parser.add_argument('--text_base', type=str, required=True, help='Detector proposal directory')
+    parser.add_argument('--output', type=str, required=True, help='.jsonl file, or a directory of parquet parts otherwise')
+    parser.add_argument('--checkpoint', type=str, default='./models/mmbcd/model_best.pt', help='model_best.pt of a training run')
+    parser.add_argument('--backend_path', type=str, default=None, help='Exported model from export.py instead of the checkpoint')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size')
+    parser.add_argument('--workers', type=int, default=8, help='DataLoader workers')
+    parser.add_argument('--topk', type=int, default=8, help='Proposals per image')
+    parser.add_argument('--img_size', type=int, default=224, help='Crop size')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'], help='Autocast precision')
+    parser.add_argument('--chunk_rows', type=int, default=50000, help='Manifest rows read, and datasets built, at a time')
+    parser.add_argument('--flush_rows', type=int, default=4096, help='Scored rows per durable write to the output')
+    parser.add_argument('--ragged_rois', action='store_true', help='For checkpoints trained with --ragged_rois')
+    parser.add_argument('--uint8_crops', action='store_true', help='uint8 single-channel crops')
+    parser.add_argument('--proposal_store', type=str, default=None, help='Compiled proposal store (data.py)')
+    parser.add_argument('--fpr', type=float, default=0.3, help='FPR of the reported recall')
+    return parser.parse_args()
+
+
+class JsonlOutput():
+    # one JSON object per scored row, appended and fsynced per write
+    block_size = 1 << 16
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isfile(path):
+            return
+        # a crash mid-write leaves a torn last line, cut back to the last complete one
+        # the file is scanned backwards from EOF in blocks, only the torn tail is read
+        with open(path, 'rb+') as f:
+            size = end = f.seek(0, os.SEEK_END)
+            while end > 0:
+                start = max(end - self.block_size, 0)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b'\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                f.truncate(end)
+
+    def read(self, columns):
+        if not os.path.isfile(self.path):
+            return pd.DataFrame(columns=columns)
+        chunks = [chunk.reindex(columns=columns) for chunk in pd.read_json(self.path, lines=True, chunksize=200000)]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=columns)
+
+    def write(self, records):
+        with open(self.path, 'a') as f:
+            for record in pd.DataFrame(records).to_dict('records'):
+                f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class ParquetOutput():
+    # a directory of parquet parts, each written to a temporary file and renamed, so a part is all or nothing
+    def __init__(self, path):
+        assert pa is not None, 'parquet output needs pyarrow, or use a .jsonl output'
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.parts = len(self.part_paths())
+
+    def part_paths(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+
+    def read(self, columns):
+        paths = self.part_paths()
+        if not paths:
+            return pd.DataFrame(columns=columns)
+        tables = [pq.read_table(path, columns=[name for name in columns if name in pq.read_schema(path).names]) for path in paths]
+        return pa.concat_tables(tables, promote_options='default').to_pandas().reindex(columns=columns)
+
+    def write(self, records):
+        path = os.path.join(self.path, f'part-{self.parts:06d}.parquet')
+        tmp_path = path + f'.tmp{os.getpid()}'
+        pq.write_table(pa.Table.from_pydict(records), tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.parts += 1
+
+
+def open_output(path):
+    return JsonlOutput(path) if path.endswith('.jsonl') else ParquetOutput(path)
+
+
+def manifest_chunks(csv_path, chunk_rows, done):
+    # (row numbers, DataFrame) of the rows not scored yet, chunk_rows manifest rows at a time
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_rows):
+        rows = chunk.index.to_numpy()
+        chunk = chunk[~np.isin(rows, done)].reset_index(drop=True)
+        if len(chunk) == 0:
+            continue
+        labeled = 'cancer' in chunk.columns
+        # unlabeled manifests get the label-free prompt ('Indication: {text}')
+        if not labeled:
+            chunk['cancer'] = 0
+        if 'all_views_cancer' not in chunk.columns:
+            chunk['all_views_cancer'] = 0
+        yield rows[~np.isin(rows, done)], chunk, labeled
+
+
+def score_manifest(model, tokenizer, output, csv_path, img_base, text_base, batch_size=32, workers=8, topk=8, img_size=224, precision='fp32', chunk_rows=50000, flush_rows=4096, **dataset_kwargs):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    done = output.read(['row'])['row'].to_numpy(dtype=np.int64)
+    print(f'{len(done)} rows already scored')
+
+    set_precision(model, precision)
+    model.eval()
+    records = {'row': [], 'im_path': [], 'label': [], 'probability': []}
+    for rows, chunk, labeled in manifest_chunks(csv_path, chunk_rows, done):
+        dataset = all_mammo(chunk, img_base, text_base, topk=topk, img_size=img_size, mask_ratio=0, enable_mask=False, tokenizer=tokenizer, **dataset_kwargs)
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers, collate_fn=dataset.collate)
+        with torch.no_grad():
+            for batch in tqdm(dataloader):
+                crops, inputids, attmask, labels = batch_inputs(batch, tokenizer)
+                roi_mask = batch_roi_mask(batch, device)
+                with autocast(device, precision):
+                    logits, _ = model(crops.to(device), inputids.to(device), attmask.to(device), roi_mask=roi_mask)
+                index = batch['index'].numpy()
+                records['row'].extend(rows[index].tolist())
+                records['im_path'].extend(chunk['im_path'].iloc[index].tolist())
+                records['label'].extend(labels.tolist() if labeled else [None] * len(index))
+                records['probability'].extend(F.softmax(logits.float(), dim=-1)[:, 1].tolist())
+                if len(records['row']) >= flush_rows:
+                    output.write(records)
+                    records = {name: [] for name in records}
+    if records['row']:
+        output.write(records)
+
+
+def summarize(output, fpr=0.3):
+    # metrics from the output alone, so they also cover rows scored by earlier runs
+    df = output.read(['row', 'label', 'probability']).drop_duplicates('row', keep='last')
+    summary = {'rows': len(df), 'mean_probability': float(df['probability'].mean()) if len(df) else None}
+    df = df.dropna(subset=['label'])
+    if len(df) and df['label'].nunique() == 2:
+        labels = df['label'].astype(int).tolist()
+        probabilities = df['probability'].tolist()
+        predictions = [int(probability >= 0.5) for probability in probabilities]
+        summary.update({
+            'labeled_rows': len(df),
+            'accuracy': accuracy_score(labels, predictions),
+            'f1': f1_score(labels, predictions),
+            'auc': roc_auc_score(labels, probabilities),
+            f'recall@fpr{fpr}': recall2FPR(probabilities, labels, fpr)[0],
+        })
+    return summary
+
+
+if __name__=="__main__":
+    args = get_args()
+    if args.backend_path is None:
+        model, tokenizer = load_model_again(args.checkpoint, None, 0, args.img_size, None, 0)
+    else:
+        model, tokenizer = load_backend(args.backend_path), RobertaTokenizerFast.from_pretrained('roberta-base')
+
+    output = open_output(args.output)
+    dataset_kwargs = {'ragged_rois': args.ragged_rois, 'uint8_crops': args.uint8_crops, 'proposal_store': args.proposal_store}
+    score_manifest(model, tokenizer, output, args.csv, args.img_base, args.text_base, args.batch_size, args.workers, args.topk, args.img_size, args.precision, args.chunk_rows, args.flush_rows, **dataset_kwargs)
+
+    summary = summarize(output, args.fpr)
+    print(json.dumps(summary, indent=2))
+    with open(os.path.splitext(args.output.rstrip('/'))[0] + '_summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
@@ -0,0 +1,234 @@
+import io
+import os
+import json
+import time
+import queue
+import base64
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+
+from predict import ExamPredictor
+from test import load_model_again
+
+# POST /predict  {"uhid": ..., "history": ..., "views": [{"image": path | "image_base64": ..., "boxes": [[cx, cy, w, h, conf], ...] | txt path}]}
+#   -> ExamPredictor result with per-view boxes and attention weights; 503 when the queue is full
+#   paths are only read under the server's data_root (403 otherwise), without one only bytes and inline boxes
+# GET /metrics   queue depth, counters, batch sizes and latency percentiles
+# GET /health
+
+
+class ServerMetrics():
+    # counters plus the last `window` latencies (ms) and batch sizes, shared by the handler and batcher threads
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {'requests': 0, 'completed': 0, 'rejected': 0, 'failed': 0, 'batches': 0}
+        self.latency_ms = deque(maxlen=window)
+        self.queue_ms = deque(maxlen=window)
+        self.forward_ms = deque(maxlen=window)
+        self.batch_exams = deque(maxlen=window)
+        self.batch_views = deque(maxlen=window)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def record_batch(self, exams, views, queue_ms, forward_ms):
+        with self.lock:
+            self.counters['batches'] += 1
+            self.batch_exams.append(exams)
+            self.batch_views.append(views)
+            self.queue_ms.extend(queue_ms)
+            self.forward_ms.append(forward_ms)
+
+    def record_request(self, latency_ms):
+        with self.lock:
+            self.counters['completed'] += 1
+            self.latency_ms.append(latency_ms)
+
+    def summary(self, values):
+        if not values:
+            return None
+        values = np.array(values)
+        return {'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)), 'p99': float(np.percentile(values, 99))}
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            return {
+                'uptime_s': time.time() - self.started,
+                'queue_depth': queue_depth,
+                **self.counters,
+                'latency_ms': self.summary(self.latency_ms),
+                'queue_ms': self.summary(self.queue_ms),
+                'forward_ms': self.summary(self.forward_ms),
+                'batch_exams': self.summary(self.batch_exams),
+                'batch_views': self.summary(self.batch_views),
+            }
+
+
+class MicroBatcher():
+    # one worker thread coalesces queued exams into a single ExamPredictor.predict_batch call;
+    # a batch closes at max_batch_views views, or once the queue is empty max_wait_ms after its first exam was queued
+    # the queue is bounded, a full queue rejects new exams instead of growing the latency
+    def __init__(self, predictor, max_batch_views=32, max_wait_ms=10, max_queue=256, metrics=None):
+        self.predictor = predictor
+        self.max_batch_views = max_batch_views
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, exam):
+        # a prepared exam -> Future of its result; raises queue.Full under backpressure
+        future = Future()
+        self.queue.put_nowait((exam, future, time.perf_counter()))
+        return future
+
+    def collect(self, first):
+        batch = [first]
+        views = len(first[0]['crops'])
+        deadline = first[2] + self.max_wait
+        while views < self.max_batch_views:
+            # past the deadline only exams already queued join, without waiting
+            try:
+                item = self.queue.get(timeout=max(deadline - time.perf_counter(), 0))
+            except queue.Empty:
+                break
+            if views + len(item[0]['crops']) > self.max_batch_views:
+                # opens the next batch instead
+                return batch, item
+            batch.append(item)
+            views += len(item[0]['crops'])
+        return batch, None
+
+    def run(self):
+        pending = None
+        while True:
+            first = pending if pending is not None else self.queue.get()
+            batch, pending = self.collect(first)
+            start = time.perf_counter()
+            try:
+                results = self.predictor.predict_batch([exam for exam, _, _ in batch], return_attention=True)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            self.metrics.record_batch(len(batch), sum(len(exam['crops']) for exam, _, _ in batch),
+                                      [(start - queued) * 1000 for _, _, queued in batch], (time.perf_counter() - start) * 1000)
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+def resolve_path(path, data_root):
+    # a file named by a request: relative paths are taken from data_root, and nothing may resolve outside it
+    if data_root is None:
+        raise PermissionError('the server reads no files, send image_base64 and inline boxes')
+    root = os.path.realpath(data_root)
+    resolved = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, resolved]) != root:
+        raise PermissionError(f'{path} is outside the data root')
+    return resolved
+
+
+def read_exam(predictor, body, data_root=None):
+    # request JSON -> prepared exam (image decoding and cropping run in the handler thread)
+    images = []
+    proposals = []
+    for view in body['views']:
+        if 'image_base64' in view:
+            images.append(Image.open(io.BytesIO(base64.b64decode(view['image_base64']))))
+        else:
+            images.append(resolve_path(view['image'], data_root))
+        boxes = view['boxes']
+        proposals.append(resolve_path(boxes, data_root) if isinstance(boxes, str) else np.asarray(boxes, dtype=np.float32).reshape(-1, 5))
+    return predictor.prepare(body.get('uhid'), images, proposals, body.get('history', ''))
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, payload, headers=()):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.server.batcher.metrics.snapshot(self.server.batcher.queue.qsize()))
+        elif self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'unknown path {self.path}'})
+            return
+        start = time.perf_counter()
+        metrics = self.server.batcher.metrics
+        metrics.count('requests')
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            exam = read_exam(self.server.batcher.predictor, body, self.server.data_root)
+        except PermissionError as error:
+            metrics.count('failed')
+            self.send_json(403, {'error': str(error)})
+            return
+        except Exception as error:
+            metrics.count('failed')
+            self.send_json(400, {'error': repr(error)})
+            return
+        try:
+            future = self.server.batcher.submit(exam)
+        except queue.Full:
+            metrics.count('rejected')
+            self.send_json(503, {'error': 'queue full'}, [('Retry-After', '1')])
+            return
+        try:
+            result = future.result(timeout=self.server.request_timeout)
+        except Exception as error:
+            metrics.count('failed')
+            self.send_json(500, {'error': repr(error)})
+            return
+        metrics.record_request((time.perf_counter() - start) * 1000)
+        self.send_json(200, result)
+
+    def log_message(self, format, *args):
+        # per-request logging would dominate the latency under load, /metrics has the numbers
+        pass
+
+
+def make_server(predictor, host='127.0.0.1', port=8000, max_batch_views=32, max_wait_ms=10, max_queue=256, request_timeout=60, data_root=None):
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.batcher = MicroBatcher(predictor, max_batch_views, max_wait_ms, max_queue)
+    server.request_timeout = request_timeout
+    server.data_root = data_root
+    return server
+
+
+if __name__=="__main__":
+    checkpoint_path = "./models/mmbcd/model_best.pt"
+    host = '127.0.0.1'
+    port = 8000
+    topk = 8
+    img_size = 224
+    precision = 'fp32'
+    max_batch_views = 32 # views (images) per forward, about batch_size of test.py
+    max_wait_ms = 10 # longest a request waits for others to join its batch
+    max_queue = 256 # queued exams before requests get 503
+    data_root = "inhouse2_DATA" # image / box paths of requests must lie under it, None accepts only bytes and inline boxes
+
+    model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    predictor = ExamPredictor(model, tokenizer, img_size, topk, precision=precision)
+    server = make_server(predictor, host, port, max_batch_views, max_wait_ms, max_queue, data_root=data_root)
+    print(f"Serving on http://{host}:{port}")
+    server.serve_forever()
@@ -7,15 +7,17 @@ from tqdm import tqdm
 import matplotlib.pyplot as plt
 import torch.nn.functional as F
 from model import MMBCD
-from transformers import RobertaTokenizer
+from transformers import RobertaTokenizerFast
 import shutil
 import numpy as np
 import os
-from data import all_mammo
+from data import all_mammo, batch_inputs, batch_roi_mask
+from precision import autocast, set_precision
+from backends import load_backend
     
-def load_data(CSV, IMG_BASE, TEXT_BASE, workers=8, batch_size=32, topk=5, img_size=224):
-    dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, mask_ratio=0, enable_mask=False)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers) 
+def load_data(CSV, IMG_BASE, TEXT_BASE, workers=8, batch_size=32, topk=5, img_size=224, **dataset_kwargs):
+    dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, mask_ratio=0, enable_mask=False, **dataset_kwargs)
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers, collate_fn=dataset.collate) 
 
     return dataloader
 
@@ -29,17 +31,19 @@ def remove_module_prefix(state_dict):
             new_state_dict[key] = value
     return new_state_dict
 
-def load_model_again(checkpoint_path, checkpoint_path_r50, r50_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze):
+def load_model_again(checkpoint_path, checkpoint_path_r50, r50_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze, sentence_cache_size=20000):
     device = "cuda" if torch.cuda.is_available() else "cpu" 
     print(device)
 
     model = MMBCD(checkpoint_path_r50, r50_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
     model.load_state_dict(remove_module_prefix(torch.load(checkpoint_path)))
+    # exams repeat the same history for every view, each distinct prompt is encoded once
+    model.enable_sentence_cache(sentence_cache_size)
     model.to(device)
 
     model = torch.nn.DataParallel(model)
     model_name = 'roberta-base'
-    tokenizer = RobertaTokenizer.from_pretrained(model_name)
+    tokenizer = RobertaTokenizerFast.from_pretrained(model_name)
 
     return model, tokenizer
 
@@ -92,10 +96,12 @@ def fpr_r1(y_true, y_logits, im_paths):
     # return fpr, final_indices
     
 
-def test_code(model, tokenizer, test_dataloader, plot_path, file_path):
+def test_code(model, tokenizer, test_dataloader, plot_path, file_path, precision='fp32', device=None):
     file = open(file_path, "w")
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
 
+    set_precision(model, precision)
     model.eval()
     predictions = []
     true_labels = []
@@ -103,20 +109,18 @@ def test_code(model, tokenizer, test_dataloader, plot_path, file_path):
     # images= []
     with torch.no_grad():
         for batch in tqdm(test_dataloader):
-            crops, texts, labels = batch 
-            # images.extend(img_path)
-            texts = tokenizer(list(texts), padding=True, truncation=True, return_tensors='pt', max_length=90)
-            inputids = texts['input_ids']
-            attmask = texts['attention_mask']
+            crops, inputids, attmask, labels = batch_inputs(batch, tokenizer)
 
             crops = crops.to(device)
             labels = labels.to(device)
             inputids = inputids.to(device)
             attmask = attmask.to(device)
+            roi_mask = batch_roi_mask(batch, device)
 
-            logits, _ = model(crops, inputids, attmask)
+            with autocast(device, precision):
+                logits, _ = model(crops, inputids, attmask, roi_mask=roi_mask)
             # import pdb; pdb.set_trace()
-            probabilities = F.softmax(logits, dim=-1)
+            probabilities = F.softmax(logits.float(), dim=-1)
             pred = probabilities.max(1, keepdim=True)[1]
             greater_prob = [x[1] for x in probabilities.tolist()]
             
@@ -151,6 +155,8 @@ def test_code(model, tokenizer, test_dataloader, plot_path, file_path):
         plt.savefig(plot_path)
         plt.show()
 
+    return {'accuracy': accuracy, 'f1': f1, 'auc': auc_score, 'recall@fpr0.3': recall}
+
 if __name__=="__main__":
     TEST_CSV = "inhouse2_DATA/inhouse2_data.csv"
     TEST_IMG_BASE = "inhouse2_DATA/Mammo_PNG"
@@ -164,18 +170,32 @@ if __name__=="__main__":
     batch_size = 32
     topk = 8
     img_size = 224
+    precision = 'fp32' # 'bf16' on CPU or recent GPUs, 'fp16' on older GPUs
+    backend_path = None # e.g. "./models/mmbcd/model_best.onnx" from export.py, None runs the eager model
 
     layers_freeze = 2
 
+    dataset_kwargs = {
+        'proposal_store': None, # e.g. "inhouse2_DATA/proposals_top8.bin" to compile the proposals once
+        'build_workers': 8,
+        'crop_backend': 'pil',
+        'uint8_crops': False,
+        'ragged_rois': False, # True only for checkpoints trained with --ragged_rois
+    }
+
     print(f'topk = {topk}\nnum_workers = {num_workers}\nbatch_size = {batch_size}\nimage = {img_size}\nlayers_freeze = {layers_freeze}')
 
     # model = load_model_again(checkpoint_path, layers_freeze, img_size)
-    model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    if backend_path is None:
+        model, tokenizer = load_model_again(checkpoint_path, None, 0, img_size, None, 0)
+    else:
+        model, tokenizer = load_backend(backend_path), RobertaTokenizerFast.from_pretrained('roberta-base')
+    dataset_kwargs['tokenizer'] = tokenizer
     print("Loading validation DataLoader: ")
-    val_dataloader = load_data(TEST_CSV, TEST_IMG_BASE, TEST_TEXT_BASE, num_workers, batch_size, topk, img_size)    
+    val_dataloader = load_data(TEST_CSV, TEST_IMG_BASE, TEST_TEXT_BASE, num_workers, batch_size, topk, img_size, **dataset_kwargs)    
 
     print("Now Testing: ")
     # test_code(model, val_dataloader, plot_path, score_file)
-    test_code(model, tokenizer, val_dataloader, plot_path, score_file)
+    test_code(model, tokenizer, val_dataloader, plot_path, score_file, precision)
 
     
@@ -7,16 +7,16 @@ from tqdm import tqdm
 import matplotlib.pyplot as plt
 import torch.nn.functional as F
 from model import MMBCD
-from transformers import RobertaTokenizer
+from transformers import RobertaTokenizerFast
 import shutil
 import numpy as np
 import os
 from sklearn.manifold import TSNE
-from data import all_mammo
+from data import all_mammo, batch_inputs
     
 def load_data(CSV, IMG_BASE, TEXT_BASE, workers=8, batch_size=32, topk=5, img_size=224):
     dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, mask_ratio=0)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers) 
+    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers, collate_fn=dataset.collate) 
 
     return dataloader
 
@@ -40,7 +40,7 @@ def load_model_again(checkpoint_path, checkpoint_path_r50, r50_layers_freeze, r5
 
     model = torch.nn.DataParallel(model)
     model_name = 'roberta-base'
-    tokenizer = RobertaTokenizer.from_pretrained(model_name)
+    tokenizer = RobertaTokenizerFast.from_pretrained(model_name)
 
     return model, tokenizer
 
@@ -130,10 +130,7 @@ def test_code(model, tokenizer, test_dataloader, plot_path, file_path, logits_sa
     # images= []
     with torch.no_grad():
         for batch in tqdm(test_dataloader):
-            crops, texts, labels = batch 
-            texts = tokenizer(list(texts), padding=True, truncation=True, return_tensors='pt', max_length=90)
-            inputids = texts['input_ids']
-            attmask = texts['attention_mask']
+            crops, inputids, attmask, labels = batch_inputs(batch, tokenizer)
 
             crops = crops.to(device)
             labels = labels.to(device)
@@ -173,7 +173,7 @@ def test_code(model, tokenizer, test_dataloader, plot_path, file_path, output_pa
             inputids = inputids.to(device)
             attmask = attmask.to(device)
 
-            logits, attn_weights = model(crops, inputids, attmask)
+            logits, _, attn_weights = model(crops, inputids, attmask, return_attention=True)
             # import pdb; pdb.set_trace()
             probabilities = F.softmax(logits, dim=-1)
             pred = probabilities.max(1, keepdim=True)[1]
@@ -7,14 +7,22 @@ import matplotlib.pyplot as plt
 import torch.nn as nn
 import os
 import numpy as np
+import random
 
 from args import get_args
 from model import MMBCD
-from data import all_mammo
+from data import all_mammo, batch_inputs, batch_roi_mask
 from test import test_code, load_model_again
-from transformers import RobertaTokenizer
+from transformers import RobertaTokenizerFast
 
-from torch.utils.data.sampler import WeightedRandomSampler
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import SequentialSampler
+from sampler import BucketedWeightedBatchSampler, DistributedWeightedSampler, SkipSampler
+from precision import autocast, grad_scaler, set_precision
+from feature_store import FeatureStore
+from distributed import init_distributed, is_main_process, get_rank, get_world_size, barrier, all_reduce_sum, all_gather_object, main_process_first, cleanup
+from checkpoint import AsyncCheckpointer, rng_state, set_rng_state
 
 seed = 42
 torch.manual_seed(seed)
@@ -22,9 +30,11 @@ torch.cuda.manual_seed(seed)
 
 seed_value = 42
 np.random.seed(seed_value)
+# pad_proposals draws from random, a resumed process rebuilds the same padded proposals
+random.seed(seed_value)
 
 def make_weights(train_targets, prob_malignant):
-    class_sample_counts = [train_targets.count(class_idx) for class_idx in range(2)]
+    class_sample_counts = np.bincount(np.asarray(train_targets, dtype=np.int64), minlength=2)[:2]
     weights = np.array(class_sample_counts, dtype=np.float32)
 
     class_weights = [1-prob_malignant, prob_malignant] / weights
@@ -37,156 +47,307 @@ def make_weights(train_targets, prob_malignant):
 
     return train_targets
 
-def load_data(CSV, IMG_BASE, TEXT_BASE, prob_malignant=0.5, type=1, workers=8, batch_size=32, topk=5, img_size=224):
-    # 1 for train 0 for test
+def load_data(CSV, IMG_BASE, TEXT_BASE, prob_malignant=0.5, type=1, workers=8, batch_size=32, topk=5, img_size=224, bucket_by_length=False, rank=0, world_size=1, **dataset_kwargs):
+    # 1 for train 0 for test, bucket_by_length only applies to train
+    # under DDP batch_size is per process
+    # every sampler is wrapped in SkipSampler and redraws the same order per epoch, so training can resume mid-epoch
      
     if type == 1:
-        dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, mask_ratio=0.2, enable_mask=True)
-        print(f'Malignancy Count: {(sum(dataset.label) / len(dataset.label)) * 100 if dataset.label else 0}')
+        dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, mask_ratio=0.2, enable_mask=True, **dataset_kwargs)
+        print(f'Malignancy Count: {(dataset.label.sum() / len(dataset.label)) * 100 if len(dataset.label) else 0}')
         train_targets = dataset.label
         train_targets = make_weights(train_targets, prob_malignant)
-        train_targets = train_targets.to("cuda")
-        sampler = WeightedRandomSampler(train_targets, train_targets.shape[0]*2, replacement=True)
+        if bucket_by_length and not dataset.pretokenized:
+            raise ValueError('bucket_by_length needs prompt lengths, pass a tokenizer to pre-tokenize the prompts')
+        if bucket_by_length:
+            # same weighted draw, batches grouped by prompt length to cut padding
+            batch_sampler = SkipSampler(BucketedWeightedBatchSampler(train_targets, dataset.prompt_lengths, batch_size, train_targets.shape[0]*2, drop_last=True, num_replicas=world_size, rank=rank))
+            dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=workers, collate_fn=dataset.collate, persistent_workers=workers > 0)
+        else:
+            # WeightedRandomSampler's draw, seeded per epoch instead of from the global RNG
+            sampler = SkipSampler(DistributedWeightedSampler(train_targets, train_targets.shape[0]*2, num_replicas=world_size, rank=rank))
+            dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=workers, drop_last=True, collate_fn=dataset.collate, persistent_workers=workers > 0) 
         print("Made Train Dataloader")
-        dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=workers, drop_last=True) 
     else: 
-        dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, enable_mask=False)
-        dataloader = DataLoader(dataset, batch_size=batch_size, num_workers=workers, drop_last=True) 
+        dataset = all_mammo(CSV, IMG_BASE, TEXT_BASE, topk=topk, img_size=img_size, enable_mask=False, **dataset_kwargs)
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=False, drop_last=True) if world_size > 1 else SequentialSampler(dataset)
+        sampler = SkipSampler(sampler)
+        dataloader = DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=workers, drop_last=True, collate_fn=dataset.collate, persistent_workers=workers > 0) 
         print("Made Test Dataloader")
 
     return dataset, dataloader
 
-def load_model(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze):
-    device = "cuda" if torch.cuda.is_available() else "cpu" 
+def load_model(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze, device=None, ddp=False, grad_checkpointing=False, crop_chunk_size=0, freeze_prefix=False, text_cache_size=0, sentence_cache_size=20000, dedup_crops=False):
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu" 
     print(device)
 
     # model = R50_RoBERTa(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
-    model = MMBCD(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
+    model = MMBCD(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze, grad_checkpointing, crop_chunk_size, dedup_crops)
     # model = VIT_RoBERTa(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
+    if freeze_prefix:
+        model.freeze_prefix()
+    model.enable_text_cache(text_cache_size)
+    model.enable_sentence_cache(sentence_cache_size)
     model.to(device)
 
-    model = torch.nn.DataParallel(model)
+    if ddp:
+        # one process per device; state_dict keys keep the same 'module.' prefix as DataParallel
+        device = torch.device(device)
+        model = DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+    else:
+        model = torch.nn.DataParallel(model)
     model_name = 'roberta-base'
-    tokenizer = RobertaTokenizer.from_pretrained(model_name)
+    tokenizer = RobertaTokenizerFast.from_pretrained(model_name)
 
     return model, tokenizer
 
-def train_code(model, train_dataloader, val_dataloader,train_dataset, file_path, checkpoint_path, plot_path, tokenizer, num_epochs=50, learning_rate=5e-3):
-    file = open(file_path, "w")
-    file.close()
+def set_epoch(dataloader, epoch):
+    for sampler in (dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+def skip_batches(dataloader, batches):
+    # the next pass over the dataloader starts at batch `batches`
+    if isinstance(dataloader.batch_sampler, SkipSampler):
+        dataloader.batch_sampler.skip(batches)
+    elif isinstance(dataloader.sampler, SkipSampler):
+        dataloader.sampler.skip(batches * dataloader.batch_size)
+    else:
+        raise ValueError('resuming mid-epoch needs a SkipSampler, build the dataloader with load_data')
+
+def make_feature_store(model, store_dir, img_size, storage='fp16', budget_gb=256, rank=0, world_size=1):
+    # frozen ViT prefix tokens per crop; every DDP rank appends to its own store
+    if world_size > 1:
+        store_dir = os.path.join(store_dir, f'rank{rank}')
+    vit = model.module.image_encoder
+    num_tokens = (img_size // vit.patch_embed.patch_size) ** 2 + 1
+    return FeatureStore(store_dir, num_tokens, vit.embed_dim, storage, namespace=model.module.prefix_fingerprint(), budget_gb=budget_gb)
+
+def store_forward(model, feature_store, keys, crops, inputids, attmask, device, roi_mask=None):
+    # the (real) crops with stored prefix tokens resume from them, only the others go through the
+    # frozen prefix, and their newly computed prefix tokens are stored
+    if roi_mask is not None:
+        keys = keys[:, :roi_mask.shape[1]]
+    valid = np.ones(keys.shape, dtype=bool) if roi_mask is None else roi_mask.cpu().numpy()
+    prefix, hit = feature_store.get(keys[valid], device)
+    if prefix is None:
+        logits, embeddings, prefix = model(crops, inputids, attmask, roi_mask=roi_mask, return_prefix=True)
+        feature_store.put(keys[valid], prefix.reshape(-1, *prefix.shape[-2:]))
+        return logits, embeddings
+
+    stored = np.zeros(keys.shape, dtype=bool)
+    stored[valid] = hit
+    stored = torch.from_numpy(stored).to(device)
+    tokens = prefix.new_zeros(keys.shape + prefix.shape[1:])
+    tokens[stored] = prefix
+    if hit.all():
+        return model(tokens, inputids, attmask, roi_mask=roi_mask, from_prefix=True)
+    logits, embeddings, prefix = model(crops, inputids, attmask, roi_mask=roi_mask, return_prefix=True, prefix=tokens, prefix_mask=stored)
+    # prefix rows follow keys[valid], as for the full forward
+    prefix = prefix.reshape(-1, *prefix.shape[-2:])
+    feature_store.put(keys[valid][~hit], prefix[torch.from_numpy(~hit).to(prefix.device)])
+    return logits, embeddings
+
+def train_code(model, train_dataloader, val_dataloader,train_dataset, file_path, checkpoint_path, plot_path, tokenizer, num_epochs=50, learning_rate=5e-3, device=None, precision='fp32', feature_store=None, state_path=None, checkpoint_every=0, resume=False):
+    # under DDP only rank 0 writes stats, plots and checkpoints; losses are averaged over all ranks
+    # state_path: full training state (model, optimizer, scaler, counters, RNG, epoch/step), written
+    #   every checkpoint_every steps and after each epoch; resume continues from it at the exact batch
+    main_process = is_main_process()
+    resume_state = None
+    if resume and state_path is not None and os.path.isfile(state_path):
+        resume_state = torch.load(state_path, map_location='cpu', weights_only=False)
+    if main_process and resume_state is None:
+        file = open(file_path, "w")
+        file.close()
+    # checkpoints are written on a background thread
+    checkpointer = AsyncCheckpointer() if main_process else None
 
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate,betas=(0.9,0.98),eps=1e-6)
     loss_criterion = nn.CrossEntropyLoss()
     # scheduler = LambdaLR(optimizer, lr_lambda=lambda epoch: 0.1 if epoch == 19 else 1)
     # scheduler = ReduceLROnPlateau(optimizer, mode='min', patience=10, factor=0.5, verbose=True)
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    # no-op unless training fp16 on a GPU
+    scaler = grad_scaler(device, precision)
+    set_precision(model, precision)
 
     val_max = sys.maxsize
     loss_list_val = []
     loss_list_train = []
     exit_cnt = 0
-
-    for epoch in range(num_epochs):
-        train_dataset.select_random_words()
-        file = open(file_path, "a")
-        print(f'Started Epoch #{epoch+1}')
-
-        pbar_train = tqdm(train_dataloader, total=len(train_dataloader), desc='train', position=0, leave=True)
-
-        model.train()
-        avg_loss_train = 0
-        batch_num_train = 0
-        for batch in pbar_train:
-            optimizer.zero_grad()
-            crops, texts, labels = batch 
-
-            texts = tokenizer(list(texts), padding=True, truncation=True, return_tensors='pt', max_length=90)
-            inputids = texts['input_ids']
-            attmask = texts['attention_mask']
-
-            # import pdb; pdb.set_trace()
-            crops = crops.to(device)
-            labels = labels.to(device)
-            inputids = inputids.to(device)
-            attmask = attmask.to(device)
-
-            logits, _ = model(crops, inputids, attmask)
-            loss = loss_criterion(logits, labels)
-
-            avg_loss_train += loss.item()
-            batch_num_train += 1
-
-            loss.backward()
-            optimizer.step()
-
-            pbar_train.set_description(f"\tEpoch {epoch+1}/{num_epochs}, Loss: {loss.item():.4f}")
-
-        avg_loss_train /= batch_num_train 
-        tqdm.write(f'Epoch {epoch+1}: Average loss TRAIN = {avg_loss_train:.4f}')
-        file.write(f'Epoch {epoch+1}: Average loss TRAIN = {avg_loss_train:.4f}\n')
-
-        # Validation
-        model.eval()
-        pbar_test = tqdm(val_dataloader, total=len(val_dataloader), desc='val', position=0, leave=True)
-        avg_loss_val = 0
-        batch_num_val = 0
-        with torch.no_grad():
-            for batch in pbar_test:
-                crops, texts, labels = batch 
-
-                texts = tokenizer(list(texts), padding=True, truncation=True, return_tensors='pt', max_length=90)
-                inputids = texts['input_ids']
-                attmask = texts['attention_mask']
-
+    start_epoch = 0
+
+    def training_state(epoch, step, avg_loss_train, batch_num_train):
+        # collective: the running train loss is summed over all ranks, rank 0 holds it after a resume;
+        # every rank's RNG state is gathered, each draws its own dropout masks on its own device
+        avg_loss_train, batch_num_train = all_reduce_sum([avg_loss_train, batch_num_train], device)
+        rng = all_gather_object(rng_state())
+        return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'scaler': scaler.state_dict(),
+                'epoch': epoch, 'step': step, 'train_loss': (avg_loss_train, batch_num_train),
+                'val_max': val_max, 'exit_cnt': exit_cnt, 'loss_list_val': loss_list_val, 'loss_list_train': loss_list_train,
+                'rng': rng}
+
+    if resume_state is not None:
+        model.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        scaler.load_state_dict(resume_state['scaler'])
+        val_max, exit_cnt = resume_state['val_max'], resume_state['exit_cnt']
+        loss_list_val, loss_list_train = resume_state['loss_list_val'], resume_state['loss_list_train']
+        start_epoch = resume_state['epoch']
+        if main_process:
+            print(f"Resuming at epoch #{start_epoch+1}, batch {resume_state['step']}")
+
+    # a preempted run still finishes the checkpoint it is writing; model_best.pt is read back for the final test
+    try:
+        for epoch in range(start_epoch, num_epochs):
+            # new masking selection, picked up by the persistent workers through the shared bitmap
+            train_dataset.set_epoch(epoch)
+            set_epoch(train_dataloader, epoch)
+            if main_process:
+                file = open(file_path, "a")
+                print(f'Started Epoch #{epoch+1}')
+
+            total = len(train_dataloader)
+            step = 0
+            avg_loss_train = 0
+            batch_num_train = 0
+            if resume_state is not None:
+                step = resume_state['step']
+                skip_batches(train_dataloader, step)
+                if main_process:
+                    avg_loss_train, batch_num_train = resume_state['train_loss']
+            batches = iter(train_dataloader)
+            if resume_state is not None:
+                # restored once the iterator has drawn its worker seed, dropout then continues exactly
+                if len(resume_state['rng']) == get_world_size():
+                    set_rng_state(resume_state['rng'][get_rank()])
+                elif main_process:
+                    print(f"Checkpoint was written by {len(resume_state['rng'])} processes, RNG state not restored")
+                resume_state = None
+            pbar_train = tqdm(batches, total=total, initial=step, desc='train', position=0, leave=True, disable=not main_process)
+
+            model.train()
+            for batch in pbar_train:
+                optimizer.zero_grad()
+                crops, inputids, attmask, labels = batch_inputs(batch, tokenizer)
+
+                # import pdb; pdb.set_trace()
                 crops = crops.to(device)
                 labels = labels.to(device)
                 inputids = inputids.to(device)
                 attmask = attmask.to(device)
+                roi_mask = batch_roi_mask(batch, device)
+
+                with autocast(device, precision):
+                    if feature_store is not None:
+                        logits, _ = store_forward(model, feature_store, train_dataloader.dataset.crop_keys(batch['index']), crops, inputids, attmask, device, roi_mask)
+                    else:
+                        logits, _ = model(crops, inputids, attmask, roi_mask=roi_mask)
+                loss = loss_criterion(logits.float(), labels)
+
+                avg_loss_train += loss.item()
+                batch_num_train += 1
+
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                step += 1
+
+                pbar_train.set_description(f"\tEpoch {epoch+1}/{num_epochs}, Loss: {loss.item():.4f}")
+                if state_path is not None and checkpoint_every > 0 and step % checkpoint_every == 0 and step < total:
+                    state = training_state(epoch, step, avg_loss_train, batch_num_train)
+                    if main_process:
+                        checkpointer.save(state_path, state)
+
+            avg_loss_train, batch_num_train = all_reduce_sum([avg_loss_train, batch_num_train], device)
+            avg_loss_train /= batch_num_train 
+            if main_process:
+                tqdm.write(f'Epoch {epoch+1}: Average loss TRAIN = {avg_loss_train:.4f}')
+                file.write(f'Epoch {epoch+1}: Average loss TRAIN = {avg_loss_train:.4f}\n')
+
+            # Validation
+            model.eval()
+            pbar_test = tqdm(val_dataloader, total=len(val_dataloader), desc='val', position=0, leave=True, disable=not main_process)
+            avg_loss_val = 0
+            batch_num_val = 0
+            with torch.no_grad():
+                for batch in pbar_test:
+                    crops, inputids, attmask, labels = batch_inputs(batch, tokenizer)
+
+                    crops = crops.to(device)
+                    labels = labels.to(device)
+                    inputids = inputids.to(device)
+                    attmask = attmask.to(device)
+                    roi_mask = batch_roi_mask(batch, device)
+
+                    with autocast(device, precision):
+                        if feature_store is not None:
+                            logits, _ = store_forward(model, feature_store, val_dataloader.dataset.crop_keys(batch['index']), crops, inputids, attmask, device, roi_mask)
+                        else:
+                            logits, _ = model(crops, inputids, attmask, roi_mask=roi_mask)
+                    loss = loss_criterion(logits.float(), labels)
+
+                    avg_loss_val += loss.item()
+                    batch_num_val += 1
+                    pbar_test.set_description(f"\tEpoch {epoch+1}/{num_epochs}, Loss: {loss.item():.4f}")
+                # every rank sees the same reduced value, so the checkpoint / early-stop decisions agree
+                avg_loss_val, batch_num_val = all_reduce_sum([avg_loss_val, batch_num_val], device)
+                avg_loss_val /= batch_num_val
+            if feature_store is not None:
+                feature_store.flush()
+
+            loss_list_val.append(avg_loss_val)
+            loss_list_train.append(avg_loss_train) 
+            if main_process:
+                tqdm.write(f'Epoch {epoch+1}: Average loss VAL = {avg_loss_val:.4f}')
+                file.write(f'Epoch {epoch+1}: Average loss VAL = {avg_loss_val:.4f}\n')
+                # scheduler.step()
+                print(f'Epoch {epoch + 1}: Learning Rate: {optimizer.param_groups[0]["lr"]}')
+
+                plt.plot([num+1 for num in range(len(loss_list_val))], loss_list_val, label = "VAL_LOSS")
+                plt.plot([num+1 for num in range(len(loss_list_val))], loss_list_train, label = "TRAIN_LOSS")
+                plt.xlabel('Epoch #')
+                plt.ylabel('Validation & Train Loss')
+                plt.legend()
+                plt.savefig(plot_path)
+                plt.clf()
+                tqdm.write('\n\n')
+
+            # scheduler.step(avg_loss_val)
+
+            if avg_loss_val < val_max:
+                val_max = avg_loss_val
+                exit_cnt = 0
+                if main_process:
+                    checkpointer.save(checkpoint_path, model.state_dict())
+
+                    tqdm.write(f'\tEpoch #{epoch+1} - Model checkpoint saved.')
+                    file.write(f'\tEpoch #{epoch+1} - Model checkpoint saved.\n')
+                barrier()
+            else: 
+                exit_cnt += 1
+                if exit_cnt >= 50:
+                    if main_process:
+                        tqdm.write(f'\Exiting training loop due to overfitting.')
+                        file.write(f'\Exiting training loop due to overfitting.\n')
+                        file.close()
+                    break
+
+            if state_path is not None:
+                state = training_state(epoch + 1, 0, 0, 0)
+                if main_process:
+                    checkpointer.save(state_path, state)
+            if main_process:
+                file.close()
+    finally:
+        if main_process:
+            checkpointer.wait()
 
-                logits, _ = model(crops, inputids, attmask)
-                loss = loss_criterion(logits, labels)
-
-                avg_loss_val += loss.item()
-                batch_num_val += 1
-                pbar_test.set_description(f"\tEpoch {epoch+1}/{num_epochs}, Loss: {loss.item():.4f}")
-            avg_loss_val /= batch_num_val
-
-        tqdm.write(f'Epoch {epoch+1}: Average loss VAL = {avg_loss_val:.4f}')
-        file.write(f'Epoch {epoch+1}: Average loss VAL = {avg_loss_val:.4f}\n')
-        # scheduler.step()
-        print(f'Epoch {epoch + 1}: Learning Rate: {optimizer.param_groups[0]["lr"]}')
-
-        loss_list_val.append(avg_loss_val)
-        loss_list_train.append(avg_loss_train) 
-        plt.plot([num+1 for num in range(len(loss_list_val))], loss_list_val, label = "VAL_LOSS")
-        plt.plot([num+1 for num in range(len(loss_list_val))], loss_list_train, label = "TRAIN_LOSS")
-        plt.xlabel('Epoch #')
-        plt.ylabel('Validation & Train Loss')
-        plt.legend()
-        plt.savefig(plot_path)
-        plt.clf()
-        tqdm.write('\n\n')
-
-        # scheduler.step(avg_loss_val)
-
-        if avg_loss_val < val_max:
-            val_max = avg_loss_val
-            exit_cnt = 0
-            torch.save(model.state_dict(), checkpoint_path)
-
-            tqdm.write(f'\tEpoch #{epoch+1} - Model checkpoint saved.')
-            file.write(f'\tEpoch #{epoch+1} - Model checkpoint saved.\n')
-        else: 
-            exit_cnt += 1
-            if exit_cnt >= 50:
-                tqdm.write(f'\Exiting training loop due to overfitting.')
-                file.write(f'\Exiting training loop due to overfitting.\n')
-                break
-
-        file.close()
-    
     best_lr_used = optimizer.param_groups[0]['lr']
-    print(f'Best Learning Rate Used: {best_lr_used}')
+    if main_process:
+        print(f'Best Learning Rate Used: {best_lr_used}')
 
 
 if __name__=="__main__":
@@ -203,11 +364,15 @@ if __name__=="__main__":
 
 
     args = get_args()
+    # `torchrun --nproc_per_node=N train.py ...` runs DDP (gloo on CPU-only nodes), plain python keeps DataParallel
+    rank, world_size, device = init_distributed(args.dist_backend)
+    ddp = world_size > 1
 
     os.makedirs(args.checkpoint_model_save, exist_ok=True)
     checkpoint_path = os.path.join(args.checkpoint_model_save + "model_best.pt")
     file_path = os.path.join(args.checkpoint_model_save + "training_stats.txt")
     plot_path = os.path.join(args.checkpoint_model_save + "loss_plot.png")
+    state_path = os.path.join(args.checkpoint_model_save + "last.pt")
     num_epochs = args.num_epochs
     learning_rate = args.learning_rate
 
@@ -215,6 +380,17 @@ if __name__=="__main__":
     topk = args.topk
     num_workers = args.num_workers
     batch_size = args.batch_size
+    dataset_kwargs = {
+        'proposal_store': args.proposal_store,
+        'build_workers': args.build_workers,
+        'crop_cache': args.crop_cache,
+        'crop_cache_gb': args.crop_cache_gb,
+        'crop_backend': args.crop_backend,
+        'uint8_crops': args.uint8_crops,
+        'mask_vocab': args.mask_vocab,
+        'token_cache': args.token_cache,
+        'ragged_rois': args.ragged_rois,
+    }
     prob_malignant = 0.3
 
     # Model Params
@@ -226,20 +402,33 @@ if __name__=="__main__":
 
     # import pdb; pdb.set_trace()
 
-    model, tokenizer = load_model(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
-    print("Loading training DataLoader: ")
-    train_dataset, train_dataloader = load_data(TRAIN_CSV, TRAIN_IMG_BASE, TRAIN_TEXT_BASE, prob_malignant, 0, num_workers, batch_size, topk, r50_img_size)  
-    print("Loading validation DataLoader: ")
-    val_dataset, val_dataloader = load_data(EVAL_CSV, EVAL_IMG_BASE, EVAL_TEXT_BASE, prob_malignant, 0, num_workers, batch_size, topk, r50_img_size)
+    model, tokenizer = load_model(checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze, device, ddp, args.grad_checkpointing, args.crop_chunk_size, args.vit_feature_store is not None, args.text_cache_size, args.sentence_cache_size, args.dedup_crops)
+    feature_store = None
+    if args.vit_feature_store is not None:
+        feature_store = make_feature_store(model, args.vit_feature_store, r50_img_size, args.vit_feature_storage, args.vit_feature_store_gb, rank, world_size)
+    # prompts are tokenized once at dataset construction, batches arrive as padded ids
+    dataset_kwargs['tokenizer'] = tokenizer
+    # rank 0 fills the proposal store / caches first, the other ranks then just read them
+    with main_process_first():
+        print("Loading training DataLoader: ")
+        train_dataset, train_dataloader = load_data(TRAIN_CSV, TRAIN_IMG_BASE, TRAIN_TEXT_BASE, prob_malignant, 1, num_workers, batch_size, topk, r50_img_size, args.bucket_by_length, rank, world_size, **dataset_kwargs)  
+        print("Loading validation DataLoader: ")
+        val_dataset, val_dataloader = load_data(EVAL_CSV, EVAL_IMG_BASE, EVAL_TEXT_BASE, prob_malignant, 0, num_workers, batch_size, topk, r50_img_size, False, rank, world_size, **dataset_kwargs)
     val_dataset.word_mask_ratio = 0
     print("Now training: \n\n")
-    train_code(model, train_dataloader, val_dataloader, train_dataset, file_path, checkpoint_path, plot_path, tokenizer, num_epochs=num_epochs, learning_rate=learning_rate)
+    train_code(model, train_dataloader, val_dataloader, train_dataset, file_path, checkpoint_path, plot_path, tokenizer, num_epochs=num_epochs, learning_rate=learning_rate, device=device, precision=args.precision, feature_store=feature_store, state_path=state_path, checkpoint_every=args.checkpoint_every, resume=args.resume)
+    cleanup()
+    if rank != 0:
+        sys.exit(0)
+    if ddp:
+        # the final test runs on rank 0 alone, over the whole validation set
+        val_dataloader = DataLoader(val_dataset, batch_size=batch_size, num_workers=num_workers, drop_last=True, collate_fn=val_dataset.collate)
 
     checkpoint_path_test = os.path.join(args.checkpoint_model_save + "model_best.pt")
     plot_path_test = os.path.join(args.checkpoint_model_save + "result_auc_plot.png")
     score_file = os.path.join(args.checkpoint_model_save + "result_scores.txt")
 
-    test_model = load_model_again(checkpoint_path_test, checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
-    test_code(test_model, tokenizer, val_dataloader, plot_path_test, score_file)
+    test_model, _ = load_model_again(checkpoint_path_test, checkpoint_path_vit, vit_layers_freeze, r50_img_size, rob_checkpoint_path, rob_layers_unfreeze)
+    test_code(test_model, tokenizer, val_dataloader, plot_path_test, score_file, args.precision)
 
 
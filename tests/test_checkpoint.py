@@ -0,0 +1,130 @@
+import pytest
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+
+from sampler import BucketedWeightedBatchSampler, DistributedWeightedSampler, SkipSampler
+from train import skip_batches, train_code
+
+EPOCHS = 3
+BATCHES = 10
+
+
+class Preempted(Exception):
+    pass
+
+
+class TinyModel(nn.Module):
+    # train_code's view of MMBCD: (logits, embeddings) from crops and prompt tokens, with dropout
+    # so the restored RNG state matters; raises on the `preempt_at`-th training step
+    def __init__(self, preempt_at=None):
+        super().__init__()
+        self.embed = nn.Embedding(10, 4)
+        self.head = nn.Sequential(nn.Linear(8, 16), nn.Dropout(0.5), nn.Linear(16, 2))
+        self.preempt_at = preempt_at
+        self.steps = 0
+
+    def forward(self, crops, inputids, attmask, roi_mask=None):
+        if self.training:
+            self.steps += 1
+            if self.steps == self.preempt_at:
+                raise Preempted()
+        embeddings = torch.cat([crops.mean(1), (self.embed(inputids) * attmask[..., None]).mean(1)], dim=1)
+        return self.head(embeddings), embeddings
+
+
+class TinyDataset:
+    def __init__(self, size, seed):
+        generator = torch.Generator().manual_seed(seed)
+        self.crops = torch.randn(size, 3, 4, generator=generator)
+        self.input_ids = torch.randint(0, 10, (size, 6), generator=generator)
+        self.labels = torch.randint(0, 2, (size,), generator=generator)
+        self.lengths = torch.randint(5, 90, (size,), generator=generator).numpy()
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return index
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def collate(self, indices):
+        indices = torch.tensor(indices)
+        return {'crops': self.crops[indices], 'input_ids': self.input_ids[indices],
+                'attention_mask': torch.ones_like(self.input_ids[indices]), 'labels': self.labels[indices], 'index': indices}
+
+
+def make_loaders(bucketed):
+    train_dataset = TinyDataset(40, 0)
+    weights = torch.rand(40, dtype=torch.double, generator=torch.Generator().manual_seed(1))
+    if bucketed:
+        batch_sampler = SkipSampler(BucketedWeightedBatchSampler(weights, train_dataset.lengths, 8, 8 * BATCHES, bucket_batches=2))
+        train_dataloader = DataLoader(train_dataset, batch_sampler=batch_sampler, collate_fn=train_dataset.collate)
+    else:
+        sampler = SkipSampler(DistributedWeightedSampler(weights, 8 * BATCHES))
+        train_dataloader = DataLoader(train_dataset, batch_size=8, sampler=sampler, drop_last=True, collate_fn=train_dataset.collate)
+    val_dataset = TinyDataset(16, 2)
+    val_dataloader = DataLoader(val_dataset, batch_size=8, collate_fn=val_dataset.collate)
+    return train_dataset, train_dataloader, val_dataloader
+
+
+def run(model, run_dir, bucketed, resume=False):
+    train_dataset, train_dataloader, val_dataloader = make_loaders(bucketed)
+    run_dir.mkdir(exist_ok=True)
+    state_path = str(run_dir / 'last.pt')
+    train_code(model, train_dataloader, val_dataloader, train_dataset, str(run_dir / 'stats.txt'), str(run_dir / 'model_best.pt'),
+               str(run_dir / 'loss.png'), None, num_epochs=EPOCHS, learning_rate=1e-2, device='cpu',
+               state_path=state_path, checkpoint_every=3, resume=resume)
+    return torch.load(state_path, weights_only=False)
+
+
+def resume_matches_uninterrupted(tmp_path, bucketed):
+    torch.manual_seed(0)
+    expected = run(TinyModel(), tmp_path / 'full', bucketed)
+
+    # preempted during step 4 of the second epoch, the last checkpoint is after its step 3
+    torch.manual_seed(0)
+    with pytest.raises(Preempted):
+        run(TinyModel(preempt_at=BATCHES + 4), tmp_path / 'preempted', bucketed)
+    state = torch.load(str(tmp_path / 'preempted' / 'last.pt'), weights_only=False)
+    assert (state['epoch'], state['step']) == (1, 3)
+
+    # a new process: different init and global RNG, everything comes from the checkpoint
+    torch.manual_seed(123)
+    resumed = run(TinyModel(), tmp_path / 'preempted', bucketed, resume=True)
+
+    assert resumed['epoch'] == EPOCHS
+    assert resumed['loss_list_train'] == expected['loss_list_train']
+    assert resumed['loss_list_val'] == expected['loss_list_val']
+    assert resumed['model'].keys() == expected['model'].keys()
+    for name in expected['model']:
+        assert torch.equal(resumed['model'][name], expected['model'][name])
+
+
+def test_resume_mid_epoch(tmp_path):
+    resume_matches_uninterrupted(tmp_path, bucketed=False)
+
+
+def test_resume_mid_epoch_bucketed(tmp_path):
+    resume_matches_uninterrupted(tmp_path, bucketed=True)
+
+
+def test_skip_sampler_resumes_the_same_draw():
+    sampler = SkipSampler(DistributedWeightedSampler(torch.rand(30, dtype=torch.double), 60))
+    sampler.set_epoch(2)
+    full = list(sampler)
+    sampler.set_epoch(2)
+    sampler.skip(17)
+    assert len(sampler) == 43
+    assert list(sampler) == full[17:]
+    # the skip only applies to the next pass
+    assert list(sampler) == full
+
+
+def test_skip_batches_needs_a_skip_sampler():
+    loader = DataLoader(list(range(8)), batch_size=2)
+    with pytest.raises(ValueError):
+        skip_batches(loader, 1)
@@ -0,0 +1,14 @@
+import numpy as np
+
+from crop_cache import CropCache, crop_digest
+
+
+def test_crop_mode_separates_caches(tmp_path):
+    # PIL grayscale and roi_align crops both have one channel but different pixels
+    pil = CropCache(str(tmp_path), 10, 4, 32, channels=1, crop_mode='pil:1')
+    roi_align = CropCache(str(tmp_path), 10, 4, 32, channels=1, crop_mode='roi_align:1')
+    assert pil.cache_dir != roi_align.cache_dir
+
+    proposals = np.random.default_rng(0).random((4, 5)).astype(np.float32)
+    assert crop_digest('a.png', proposals, 32, 'pil:1') != crop_digest('a.png', proposals, 32, 'roi_align:1')
+    assert crop_digest('a.png', proposals, 32, 'pil:1') == crop_digest('a.png', proposals, 32, 'pil:1')
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import torch
+import torch.nn as nn
+
+from model import MMBCD
+
+
+def dedup(x, fingerprint_weights=None):
+    # unique_crops only needs the fingerprint weights, not the encoders
+    return MMBCD.unique_crops(SimpleNamespace(fingerprint_weights=fingerprint_weights or {}), x)
+
+
+def test_duplicates_encoded_once():
+    crops = torch.randint(0, 256, (4, 224, 224), dtype=torch.uint8)
+    x = crops[[0, 1, 0, 2, 3, 3]]
+    unique, inverse = dedup(x)
+    assert len(unique) == 4
+    assert torch.equal(unique[inverse], x)
+
+
+def test_distinct_uint8_crops_under_autocast():
+    # one-pixel differences used to vanish in the bf16 projection
+    crops = torch.full((3, 224, 224), 255, dtype=torch.uint8)
+    crops[1, 0, 0] = 254
+    crops[2, 223, 223] = 254
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        unique, inverse = dedup(crops[[0, 1, 2, 0]])
+    assert len(unique) == 3
+    assert torch.equal(unique[inverse], crops[[0, 1, 2, 0]])
+
+
+def test_collisions_keep_the_other_duplicates():
+    crops = torch.randint(0, 256, (3, 8, 8), dtype=torch.uint8)
+    x = crops[[0, 0, 1, 2, 2]]
+    # a zero projection puts every row in one group
+    unique, inverse = dedup(x, {(64, x.device): torch.zeros(64, 2, dtype=torch.float64)})
+    assert torch.equal(unique[inverse], x)
+    assert len(unique) == 4
+
+
+def test_no_duplicates():
+    x = torch.rand(5, 3, 16, 16)
+    unique, inverse = dedup(x)
+    assert inverse is None and unique is x
+
+
+def tiny_mmbcd(dedup_crops):
+    # MMBCD.forward around small stand-in encoders, the ViT and RoBERTa are not needed to check the gather
+    torch.manual_seed(0)
+    model = MMBCD.__new__(MMBCD)
+    nn.Module.__init__(model)
+    model.img_size = 8
+    model.precision = 'fp32'
+    model.dedup_crops = dedup_crops
+    model.fingerprint_weights = {}
+    model.text_cache = None
+    model.sentence_cache = None
+    model.crop_encoder = nn.Linear(3 * 8 * 8, 384)
+    model.word_embeddings = nn.Embedding(10, 768)
+    model.img_fc_layer = nn.Sequential(nn.BatchNorm1d(384), nn.Linear(384, 256), nn.GELU())
+    model.txt_fc_layer = nn.Sequential(nn.BatchNorm1d(768), nn.Linear(768, 256), nn.GELU())
+    model.attention = nn.MultiheadAttention(embed_dim=256, num_heads=1, batch_first=True)
+    model.model_fc2 = nn.Linear(256 * 3, 2)
+    model.encoded_rows = []
+
+    def encode_crops(x):
+        model.encoded_rows.append(len(x))
+        return model.crop_encoder(x.flatten(1))
+
+    model.encode_crops = encode_crops
+    model.encode_text = lambda inputids, attmask: model.word_embeddings(inputids).mean(1)
+    return model
+
+
+def test_forward_and_backward_match_without_dedup():
+    # float64: the deduped backward sums the copies in a different order
+    crops = torch.rand(3, 3, 8, 8, dtype=torch.float64)
+    image_tensor = crops[[0, 1, 0, 2, 2, 2, 1, 0]].reshape(2, 4, 3, 8, 8)
+    inputids = torch.randint(0, 10, (2, 5))
+    attmask = torch.ones_like(inputids)
+
+    results = []
+    for dedup_crops in (False, True):
+        model = tiny_mmbcd(dedup_crops).double()
+        model.train()
+        logits, embeddings = model(image_tensor, inputids, attmask)
+        (logits.square().sum() + embeddings.sum()).backward()
+        results.append((model, logits, {name: param.grad for name, param in model.named_parameters()}))
+
+    (plain, plain_logits, plain_grads), (deduped, deduped_logits, deduped_grads) = results
+    assert plain.encoded_rows == [8] and deduped.encoded_rows == [3]
+    assert torch.allclose(plain_logits, deduped_logits, atol=1e-6)
+    for name, grad in plain_grads.items():
+        # the copies' gradients are summed into their unique crop
+        assert torch.allclose(grad, deduped_grads[name], atol=1e-5), name
@@ -0,0 +1,58 @@
+import pytest
+import torch
+import torch.nn as nn
+
+from backends import ExportedBackend, load_backend
+from export import check_parity, export_onnx, export_torchscript
+
+
+class TinyModel(nn.Module):
+    # eager call signature of MMBCD: (crops [B, K, 3, S, S], input_ids, attention_mask) -> (logits, embeddings)
+    def __init__(self):
+        super().__init__()
+        self.crop_fc = nn.Linear(3 * 4 * 4, 8)
+        self.word_embeddings = nn.Embedding(20, 8)
+        self.fc = nn.Linear(16, 2)
+
+    def forward(self, crops, input_ids, attention_mask):
+        crops = self.crop_fc(crops.flatten(2)).amax(dim=1)
+        mask = attention_mask.unsqueeze(-1).float()
+        text = (self.word_embeddings(input_ids) * mask).sum(1) / mask.sum(1)
+        embeddings = torch.cat([crops, text], dim=1)
+        return self.fc(embeddings), embeddings
+
+
+class LogitsWrapper(nn.Module):
+    # what export.ExportWrapper does for MMBCD
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, crops, input_ids, attention_mask):
+        return self.model(crops, input_ids, attention_mask)[0]
+
+
+def inputs(batch_size, topk, length):
+    ids = torch.randint(0, 20, (batch_size, length))
+    mask = torch.ones_like(ids)
+    mask[0, length // 2:] = 0
+    return torch.randn(batch_size, topk, 3, 4, 4), ids, mask
+
+
+@pytest.mark.parametrize('name', ['model.ts', 'model.onnx'])
+def test_exported_graph_matches_eager(tmp_path, name):
+    if name.endswith('.onnx'):
+        pytest.importorskip('onnx')
+        pytest.importorskip('onnxruntime')
+    torch.manual_seed(0)
+    model = TinyModel().eval()
+    path = str(tmp_path / name)
+    export = export_onnx if name.endswith('.onnx') else export_torchscript
+    export(LogitsWrapper(model), inputs(2, 4, 6), path)
+    # other batch, topk and sequence sizes than the traced ones
+    check_parity(model, load_backend(path), inputs(3, 2, 9))
+
+
+def test_backend_needs_run():
+    with pytest.raises(TypeError):
+        ExportedBackend()
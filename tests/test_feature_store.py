@@ -0,0 +1,27 @@
+import numpy as np
+import torch
+
+from feature_store import FeatureStore
+
+
+def test_get_returns_the_hits_and_their_mask(tmp_path):
+    store = FeatureStore(str(tmp_path), num_tokens=3, dim=4, storage='fp32')
+    tokens = torch.randn(4, 3, 4)
+    keys = np.array([11, 12, 13, 14], dtype=np.uint64)
+    store.put(keys[:2], tokens[:2])
+
+    prefix, hit = store.get(keys)
+    assert hit.tolist() == [True, True, False, False]
+    assert torch.equal(prefix, tokens[:2])
+
+    # the missing rows are stored afterwards, the next lookup is a full hit
+    store.put(keys[~hit], tokens[2:])
+    prefix, hit = store.get(keys[[3, 0]])
+    assert hit.all()
+    assert torch.equal(prefix, tokens[[3, 0]])
+
+
+def test_get_without_hits(tmp_path):
+    store = FeatureStore(str(tmp_path), num_tokens=3, dim=4, storage='fp16')
+    prefix, hit = store.get(np.array([5, 6], dtype=np.uint64))
+    assert prefix is None and not hit.any()
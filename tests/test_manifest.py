@@ -0,0 +1,37 @@
+import pandas as pd
+import pytest
+
+import manifest
+from manifest import load_manifest
+
+CSV = '''UHID,text,cancer,im_path,all_views_cancer
+1,"bl mastalgia  2 months
+lump in left breast",0,1/a.png,0
+2,family history,1,2/b.png,1
+'''
+
+
+@pytest.fixture(params=['arrow', 'pandas'])
+def backend(request, monkeypatch):
+    if request.param == 'arrow':
+        pytest.importorskip('pyarrow')
+    else:
+        monkeypatch.setattr(manifest, 'pa', None)
+    return request.param
+
+
+def test_quoted_newline(tmp_path, backend):
+    path = tmp_path / 'manifest.csv'
+    path.write_text(CSV)
+    columns = load_manifest(str(path))
+    expected = pd.read_csv(path)
+    assert columns['text'].tolist() == expected['text'].tolist()
+    assert columns['im_path'].tolist() == ['1/a.png', '2/b.png']
+    assert columns['cancer'].tolist() == [0, 1]
+
+
+def test_missing_label_is_rejected(tmp_path, backend):
+    path = tmp_path / 'manifest.csv'
+    path.write_text(CSV.replace('family history,1,', 'family history,,'))
+    with pytest.raises(ValueError, match='cancer'):
+        load_manifest(str(path))
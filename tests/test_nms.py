@@ -0,0 +1,95 @@
+import copy
+import numpy as np
+import pytest
+
+from nms import batched_non_max_suppression, non_max_suppression
+
+
+def loop_calculate_iou(box1, box2):
+    # all_mammo.calculate_iou before the vectorized rewrite
+    x1, y1, w1, h1, c1 = box1
+    x2, y2, w2, h2, c2 = box2
+    x1 = x1 - w1/2; y1 = y1 - h1/2
+    x2 = x2 - w2/2; y2 = y2 - h2/2
+    x_intersection = max(x1, x2)
+    y_intersection = max(y1, y2)
+    w_intersection = max(0, min(x1 + w1, x2 + w2) - x_intersection)
+    h_intersection = max(0, min(y1 + h1, y2 + h2) - y_intersection)
+    intersection_area = w_intersection * h_intersection
+    area1 = w1 * h1
+    area2 = w2 * h2
+    union = float(area1 + area2 - intersection_area)
+    if union == 0:
+        # two zero-area boxes raise ZeroDivisionError here; box_iou_matrix gives nan, which never suppresses
+        return float('nan')
+    return intersection_area / union
+
+
+def loop_non_max_suppression(boxes, iou_threshold):
+    # all_mammo.non_max_suppression before the vectorized rewrite
+    boxes_copy = copy.deepcopy(boxes)
+    while(True):
+        selected_indices = []
+        removed_indices = []
+        for i in range(len(boxes_copy)):
+            if i in selected_indices or i in removed_indices:
+                continue
+            current_box = boxes_copy[i]
+            selected_indices.append(i)
+            for j in range(i + 1, len(boxes_copy)):
+                if j in selected_indices or j in removed_indices:
+                    continue
+                if loop_calculate_iou(current_box, boxes_copy[j]) > iou_threshold:
+                    removed_indices.append(j)
+
+        selected_indices = sorted(selected_indices)
+        if(len(selected_indices)==len(boxes_copy)):
+            break
+        else:
+            boxes_copy = boxes_copy[selected_indices]
+    return boxes_copy
+
+
+def random_boxes(rng, n):
+    boxes = rng.random((n, 5)).astype(np.float32)
+    boxes[:, 2:4] *= 0.5
+    # exact duplicates give IoU == 1 ties, quantized coordinates give IoU == threshold ties
+    if n > 3:
+        boxes[1] = boxes[0]
+        boxes[2:4, :4] = np.round(boxes[2:4, :4] * 4) / 4
+    # zero-area boxes divide 0 by 0 against each other
+    if n > 5:
+        boxes[4, 2] = 0
+        boxes[5, 3] = 0
+    return boxes
+
+
+@pytest.mark.parametrize('backend', ['numpy', 'torch'])
+@pytest.mark.parametrize('iou_threshold', [0.0, 0.1, 0.5])
+def test_matches_loop(backend, iou_threshold):
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 7, 30, 80]:
+        for _ in range(5):
+            boxes = random_boxes(rng, n)
+            expected = loop_non_max_suppression(boxes, iou_threshold)
+            np.testing.assert_array_equal(non_max_suppression(boxes, iou_threshold, backend=backend), expected)
+
+
+def test_zero_area_pair_is_not_suppressed():
+    boxes = np.array([[0.5, 0.5, 0.0, 0.2, 0.9], [0.5, 0.5, 0.0, 0.2, 0.8]], dtype=np.float32)
+    np.testing.assert_array_equal(non_max_suppression(boxes, 0.1), boxes)
+
+
+def test_single_and_empty():
+    box = np.array([[0.5, 0.5, 0.2, 0.2, 0.9]], dtype=np.float32)
+    np.testing.assert_array_equal(non_max_suppression(box, 0.1), box)
+    assert len(non_max_suppression(np.zeros((0, 5), dtype=np.float32), 0.1)) == 0
+
+
+def test_batched_matches_loop():
+    rng = np.random.default_rng(1)
+    boxes_list = [random_boxes(rng, n) for n in [0, 1, 6, 25, 3, 40]]
+    kept = batched_non_max_suppression(boxes_list, 0.1, chunk_size=4)
+    for boxes, result in zip(boxes_list, kept):
+        expected = loop_non_max_suppression(boxes, 0.1)
+        np.testing.assert_array_equal(result, expected)
@@ -0,0 +1,45 @@
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+from predict import ExamPredictor
+
+
+class MaskedMeanModel(nn.Module):
+    # MMBCD's call signature; scores a view by the mean of its real crops, padded slots must not count
+    def __init__(self):
+        super().__init__()
+        self.scale = nn.Parameter(torch.tensor(0.01))
+
+    def forward(self, crops, inputids, attmask, roi_mask=None, return_attention=False):
+        mask = roi_mask.float() if roi_mask is not None else crops.new_ones(crops.shape[:2], dtype=torch.float)
+        means = crops.float().flatten(2).mean(-1)
+        score = (means * mask).sum(1) / mask.sum(1) * self.scale
+        logits = torch.stack([-score, score], dim=1)
+        return logits, None, mask / mask.sum(1, keepdim=True)
+
+
+def tokenizer(prompts, **kwargs):
+    ids = torch.ones(len(prompts), 4, dtype=torch.long)
+    return {'input_ids': ids, 'attention_mask': torch.ones_like(ids)}
+
+
+def test_short_views_are_masked_not_repeated():
+    rng = np.random.default_rng(0)
+    image = Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8))
+    boxes = np.array([[0.3, 0.3, 0.2, 0.2, 0.9], [0.7, 0.7, 0.2, 0.2, 0.8]], dtype=np.float32)
+    predictor = ExamPredictor(MaskedMeanModel(), tokenizer, img_size=16, topk=5)
+
+    exam = predictor.prepare('u1', [image, image], [boxes, boxes[:1]], 'history')
+    assert [tuple(crops.shape) for crops in exam['crops']] == [(2, 3, 16, 16), (1, 3, 16, 16)]
+
+    first = predictor.predict_batch([exam], return_attention=True)[0]
+    second = predictor.predict_batch([exam], return_attention=True)[0]
+    assert first == second
+    assert len(first['views']) == 2
+    assert len(first['views'][0]['attention']) == 2 and len(first['views'][1]['attention']) == 1
+    # the padded slot of the one-box view gets no weight, its score is that of the box alone
+    alone = predictor.predict_batch([predictor.prepare('u2', [image], [boxes[:1]], 'history')])[0]
+    assert np.isclose(first['views'][1]['probability'], alone['probability'])
+    assert first['probability'] == max(view['probability'] for view in first['views'])
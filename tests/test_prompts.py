@@ -0,0 +1,12 @@
+import numpy as np
+
+from data import all_mammo
+
+
+def test_prompt_whitespace_is_collapsed():
+    # sample_data/test.csv has histories like 'bl mastalgia  2 months'
+    texts = ['bl mastalgia  2 months', ' lump\tleft breast ', 'no complaints']
+    prompts = all_mammo.create_valid_prompt(None, texts, np.array([0, 1, 0]), np.array([0, 0, 1]))
+    assert prompts.tolist() == ['Indication: bl mastalgia 2 months', 'Indication: lump left breast', 'Indication:']
+    # what the masked path rebuilds when no word is masked
+    assert [' '.join(prompt.split()) for prompt in prompts] == prompts.tolist()
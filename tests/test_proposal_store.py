@@ -0,0 +1,65 @@
+import os
+import numpy as np
+
+from proposal_store import MAGIC, ProposalStore, build_proposals
+
+
+def write_proposals(folder, n, seed=0):
+    rng = np.random.default_rng(seed)
+    paths = []
+    for index in range(n):
+        path = os.path.join(folder, f'{index}_preds.txt')
+        np.savetxt(path, rng.random((12, 5)).astype(np.float32) * [1, 1, 0.3, 0.3, 1])
+        paths.append(path)
+    return paths
+
+
+def header_length(path):
+    with open(path, 'rb') as f:
+        f.read(len(MAGIC))
+        return int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+
+
+def test_fetch_matches_build_and_reuses_the_store(tmp_path):
+    paths = write_proposals(str(tmp_path), 20)
+    expected_boxes, expected_counts = build_proposals(paths, 0.1, 5, progress=False)
+    store = ProposalStore(str(tmp_path / 'store.bin'), 0.1, 5)
+
+    for order in [np.arange(20), np.arange(20), np.arange(20)[::-1], np.array([3, 3, 7])]:
+        boxes, counts = store.fetch([paths[i] for i in order])
+        np.testing.assert_array_equal(boxes, expected_boxes[order])
+        np.testing.assert_array_equal(counts, expected_counts[order])
+    keys, stamps, _, _ = store.read()
+    assert len(keys) == 20 and keys[0] == os.path.abspath(paths[0]).encode('utf-8')
+
+
+def test_stale_and_new_entries(tmp_path):
+    paths = write_proposals(str(tmp_path), 6)
+    store = ProposalStore(str(tmp_path / 'store.bin'), 0.1, 5)
+    store.fetch(paths[:4])
+
+    # a rewritten file is recompiled, new files (one listed twice) are appended once
+    np.savetxt(paths[1], np.array([[0.5, 0.5, 0.1, 0.1, 0.9]], dtype=np.float32))
+    os.utime(paths[1], ns=(1, 1))
+    query = paths[:4] + [paths[5], paths[4], paths[5]]
+    boxes, counts = store.fetch(query)
+    expected_boxes, expected_counts = build_proposals(query, 0.1, 5, progress=False)
+    np.testing.assert_array_equal(boxes, expected_boxes)
+    np.testing.assert_array_equal(counts, expected_counts)
+    assert counts[1] == 1
+    assert len(store.read()[0]) == 6
+
+
+def test_header_does_not_grow_with_rows(tmp_path):
+    small = ProposalStore(str(tmp_path / 'small.bin'), 0.1, 5)
+    small.fetch(write_proposals(str(tmp_path), 2))
+    large = ProposalStore(str(tmp_path / 'large.bin'), 0.1, 5)
+    large.fetch(write_proposals(str(tmp_path), 50))
+    # params and array shapes only, the keys and stamps live in the arrays
+    assert header_length(small.store_path) < 512 and header_length(large.store_path) < 512
+
+
+def test_params_change_discards_the_store(tmp_path):
+    paths = write_proposals(str(tmp_path), 3)
+    ProposalStore(str(tmp_path / 'store.bin'), 0.1, 5).fetch(paths)
+    assert ProposalStore(str(tmp_path / 'store.bin'), 0.1, 4).read() is None
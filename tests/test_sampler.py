@@ -0,0 +1,45 @@
+import torch
+
+from sampler import BucketedWeightedBatchSampler, DistributedWeightedSampler
+
+
+def test_distributed_weighted_ranks_split_the_global_draw():
+    weights = torch.rand(50, dtype=torch.double)
+    single = DistributedWeightedSampler(weights, 100)
+    single.set_epoch(3)
+    ranks = [DistributedWeightedSampler(weights, 100, num_replicas=4, rank=rank) for rank in range(4)]
+    for sampler in ranks:
+        sampler.set_epoch(3)
+        assert len(sampler) == 25
+
+    merged = [None] * 100
+    for rank, sampler in enumerate(ranks):
+        merged[rank::4] = list(sampler)
+    assert merged == list(single)
+
+
+def test_distributed_weighted_reseeds_per_epoch():
+    sampler = DistributedWeightedSampler(torch.ones(1000, dtype=torch.double), 200)
+    sampler.set_epoch(0)
+    first = list(sampler)
+    assert list(sampler) == first
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+
+
+def test_distributed_weighted_follows_weights():
+    # zero-weight indices are never drawn
+    weights = torch.tensor([1.0, 0.0, 1.0, 0.0], dtype=torch.double)
+    assert set(DistributedWeightedSampler(weights, 400, num_replicas=2, rank=1)) <= {0, 2}
+
+
+def test_bucketed_ranks_get_disjoint_equal_batches():
+    weights = torch.rand(64, dtype=torch.double)
+    lengths = torch.randint(5, 90, (64,)).numpy()
+    ranks = [BucketedWeightedBatchSampler(weights, lengths, 4, 128, bucket_batches=4, num_replicas=3, rank=rank) for rank in range(3)]
+    batches = [list(sampler) for sampler in ranks]
+    assert all(len(rank_batches) == len(ranks[0]) for rank_batches in batches)
+
+    single = list(BucketedWeightedBatchSampler(weights, lengths, 4, 128, bucket_batches=4))
+    merged = [batch for step in zip(*batches) for batch in step]
+    assert merged == single[:len(merged)]
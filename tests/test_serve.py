@@ -0,0 +1,31 @@
+import os
+import pytest
+
+from serve import resolve_path
+
+
+def test_paths_resolve_under_the_data_root(tmp_path):
+    root = tmp_path / 'data'
+    (root / 'views').mkdir(parents=True)
+    assert resolve_path('views/a.png', str(root)) == os.path.realpath(root / 'views' / 'a.png')
+    assert resolve_path(str(root / 'views' / 'a.png'), str(root)) == os.path.realpath(root / 'views' / 'a.png')
+
+
+@pytest.mark.parametrize('path', ['../secret.txt', '/etc/passwd', 'views/../../data_other/x.png'])
+def test_paths_outside_the_data_root_are_rejected(tmp_path, path):
+    (tmp_path / 'data').mkdir()
+    with pytest.raises(PermissionError):
+        resolve_path(path, str(tmp_path / 'data'))
+
+
+def test_symlinks_out_of_the_root_are_rejected(tmp_path):
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'secret.txt').write_text('x')
+    os.symlink(tmp_path / 'secret.txt', tmp_path / 'data' / 'link.txt')
+    with pytest.raises(PermissionError):
+        resolve_path('link.txt', str(tmp_path / 'data'))
+
+
+def test_no_data_root_reads_no_files():
+    with pytest.raises(PermissionError):
+        resolve_path('a.png', None)